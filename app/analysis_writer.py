@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError, StatementError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import database, models
+from app.cache import upsert_entries
+from app.rollups import add_to_rollups
+
+logger = logging.getLogger(__name__)
+
+# Opt-in: responses stop waiting on the commit, rows are lost if the process dies before a flush
+ANALYSIS_WRITE_BEHIND = os.getenv("ANALYSIS_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+ANALYSIS_FLUSH_ROWS = int(os.getenv("ANALYSIS_FLUSH_ROWS", "500"))
+ANALYSIS_FLUSH_INTERVAL_MS = int(os.getenv("ANALYSIS_FLUSH_INTERVAL_MS", "200"))
+# Writers wait for a flush once this many rows are buffered
+ANALYSIS_BUFFER_MAX = int(os.getenv("ANALYSIS_BUFFER_MAX", "10000"))
+# Rows per INSERT statement, keeps bind parameters under driver limits
+ANALYSIS_INSERT_CHUNK = int(os.getenv("ANALYSIS_INSERT_CHUNK", "150"))
+
+
+def analysis_row(user_id, email_text: str, result: dict, analyzed_at: datetime = None) -> dict:
+    return {
+        "user_id": user_id,
+        "email_text": email_text,
+        "sentiment": result["sentiment"],
+        "tone": result["tone"],
+        "engine": result.get("engine"),
+        "analyzed_at": analyzed_at or datetime.utcnow(),
+    }
+
+
+def rejected_by_database(error: Exception) -> bool:
+    """The item itself is bad (constraint, value the column refuses); anything else, like a lost connection, is worth retrying."""
+    if isinstance(error, (IntegrityError, DataError, ValueError, TypeError)):
+        return True
+    return isinstance(error, StatementError) and not isinstance(error, DBAPIError)
+
+
+async def insert_analyses(db: AsyncSession, rows: list):
+    """Multi-row INSERT of EmailAnalysis rows plus their rollup counts, committed by the caller."""
+    for start in range(0, len(rows), ANALYSIS_INSERT_CHUNK):
+        await db.execute(insert(models.EmailAnalysis).values(rows[start:start + ANALYSIS_INSERT_CHUNK]))
+    await add_to_rollups(db, rows)
+
+
+class AnalysisWriter:
+    """Bounded in-memory buffer of analysis rows, flushed every N rows or T milliseconds."""
+
+    def __init__(self, enabled: bool, flush_rows: int, flush_interval_ms: int, max_rows: int):
+        self.enabled = enabled
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_rows = max_rows
+        self._rows = []
+        self._cache_entries = []
+        self._task = None
+        self._wakeup = None
+        self._flush_lock = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.flush_errors = 0
+        self.rows_dropped = 0
+
+    def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+        if self._rows:
+            logger.warning("Analysis writer stopped with unflushed rows", extra={"rows": len(self._rows)})
+
+    async def add(self, rows: list, cache_entries: list = ()):
+        self._rows.extend(rows)
+        self._cache_entries.extend(cache_entries)
+        if len(self._rows) >= self.max_rows or len(self._cache_entries) >= self.max_rows:
+            # Back-pressure instead of growing without bound when the database falls behind
+            await self.flush()
+        elif len(self._rows) >= self.flush_rows:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._rows and not self._cache_entries:
+                return
+            rows, self._rows = self._rows, []
+            cache_entries, self._cache_entries = self._cache_entries, []
+            try:
+                await self._write(rows, cache_entries)
+            except Exception as e:
+                self.flush_errors += 1
+                logger.warning("Failed to flush analyses, retrying one by one", extra={"rows": len(rows), "error": str(e)})
+                rows, cache_entries = await self._write_each(rows, cache_entries)
+                if rows or cache_entries:
+                    self._requeue(rows, cache_entries)
+                return
+            self.flushes += 1
+            self.rows_written += len(rows)
+
+    async def _write(self, rows: list, cache_entries: list):
+        async with database.session() as db:
+            if cache_entries:
+                # Upserted, a key another worker or request already stored must not fail the batch
+                await upsert_entries(db, cache_entries)
+            if rows:
+                await insert_analyses(db, rows)
+            await db.commit()
+
+    async def _write_each(self, rows: list, cache_entries: list):
+        """Writes items one at a time so one bad row cannot hold back the rest. Returns what is left if the database fails."""
+        items = [([row], []) for row in rows] + [([], [entry]) for entry in cache_entries]
+        for position, (item_rows, item_entries) in enumerate(items):
+            try:
+                await self._write(item_rows, item_entries)
+            except Exception as e:
+                if not rejected_by_database(e):
+                    remaining = items[position:]
+                    return [row for item, _ in remaining for row in item], [entry for _, item in remaining for entry in item]
+                self.rows_dropped += len(item_rows)
+                logger.error(
+                    "Dropping analysis the database rejected",
+                    extra={"user_id": item_rows[0]["user_id"] if item_rows else None, "cache_entry": bool(item_entries), "error": str(e)}
+                )
+                continue
+            self.rows_written += len(item_rows)
+        return [], []
+
+    def _requeue(self, rows: list, cache_entries: list):
+        # Back in front for the next flush, keeping the buffer bounded
+        rows = rows + self._rows
+        if len(rows) > self.max_rows:
+            logger.error("Analysis buffer full, dropping oldest rows", extra={"dropped": len(rows) - self.max_rows})
+            self.rows_dropped += len(rows) - self.max_rows
+        self._rows = rows[-self.max_rows:]
+        self._cache_entries = (cache_entries + self._cache_entries)[-self.max_rows:]
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "buffered": len(self._rows),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "flush_errors": self.flush_errors,
+            "rows_dropped": self.rows_dropped,
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+
+analysis_writer = AnalysisWriter(
+    enabled=ANALYSIS_WRITE_BEHIND,
+    flush_rows=ANALYSIS_FLUSH_ROWS,
+    flush_interval_ms=ANALYSIS_FLUSH_INTERVAL_MS,
+    max_rows=ANALYSIS_BUFFER_MAX
+)
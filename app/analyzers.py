@@ -0,0 +1,480 @@
+import asyncio
+import json
+import os
+import re
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+
+from app import llm, metrics
+from app.labels import SENTIMENT_LABELS, TONE_LABELS, normalize_sentiment, normalize_tone
+
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+# Bump whenever the prompt or parsing changes so cached results are not reused
+PROMPT_VERSION = "2"
+
+# openai: every email goes upstream, local: never, tiered: only what the local model is unsure about
+ANALYZER = os.getenv("ANALYZER", "tiered")
+# Local results at or above this confidence are returned without calling OpenAI
+LOCAL_CONFIDENCE_THRESHOLD = float(os.getenv("LOCAL_CONFIDENCE_THRESHOLD", "0.85"))
+# Longer emails always escalate, the lexicon cannot follow a real argument
+LOCAL_MAX_TOKENS = int(os.getenv("LOCAL_MAX_TOKENS", "60"))
+
+# Label -> {word: weight}. A word with no evidence leaves the email at the Neutral prior.
+LEXICON = {
+    "Positive": {
+        "thanks": 3.5, "thank": 3.5, "thx": 3.0, "appreciate": 3.0, "appreciated": 3.0,
+        "great": 2.5, "awesome": 3.0, "excellent": 3.0, "perfect": 3.0, "love": 2.5,
+        "glad": 2.5, "happy": 2.5, "wonderful": 3.0, "fantastic": 3.0, "amazing": 3.0,
+        "congratulations": 3.0, "congrats": 3.0, "pleased": 2.5, "good": 1.5, "nice": 1.5,
+        "helpful": 2.0, "works": 1.0, "resolved": 1.5, "welcome": 1.5, "cheers": 2.0,
+    },
+    "Negative": {
+        "unacceptable": 3.5, "disappointed": 3.0, "disappointing": 3.0, "terrible": 3.5,
+        "awful": 3.5, "horrible": 3.5, "worst": 3.5, "angry": 3.0, "furious": 3.5,
+        "broken": 2.0, "bug": 1.5, "error": 1.5, "fail": 2.0, "failed": 2.0, "failing": 2.0,
+        "problem": 1.5, "issue": 1.0, "complaint": 2.5, "refund": 2.0, "cancel": 1.5,
+        "sorry": 1.0, "unfortunately": 2.0, "annoyed": 3.0, "frustrated": 3.0, "bad": 2.0,
+        "poor": 2.0, "wrong": 1.5, "ridiculous": 3.0, "useless": 3.0, "outage": 2.5,
+    },
+    "Friendly": {
+        "thanks": 3.5, "thank": 3.0, "thx": 3.0, "hi": 1.0, "hey": 1.5, "cheers": 2.5,
+        "love": 2.0, "glad": 2.0, "happy": 1.5, "awesome": 2.0, "great": 1.5, "congrats": 2.5,
+        "congratulations": 2.0, "hope": 1.5, "enjoy": 2.0, "welcome": 2.0, "lol": 2.5,
+        "amazing": 1.5, "fantastic": 1.5, "wonderful": 1.5,
+    },
+    "Formal": {
+        "dear": 3.0, "sincerely": 3.5, "regards": 2.5, "kindly": 2.5, "please": 0.5,
+        "pursuant": 3.5, "hereby": 3.5, "attached": 1.5, "accordingly": 2.5, "respectfully": 3.0,
+        "invoice": 1.5, "confirm": 1.0, "request": 1.0, "inform": 2.0, "acknowledge": 2.0,
+    },
+    "Urgent": {
+        "urgent": 4.0, "urgently": 4.0, "asap": 4.0, "immediately": 3.5, "emergency": 4.0,
+        "critical": 3.0, "deadline": 2.5, "today": 1.0, "now": 1.0, "quickly": 2.0,
+        "outage": 3.0, "down": 1.5, "priority": 2.0,
+    },
+    "Frustrated": {
+        "unacceptable": 3.5, "ridiculous": 3.5, "again": 1.5, "still": 1.5, "frustrated": 4.0,
+        "frustrating": 4.0, "annoyed": 3.5, "annoying": 3.5, "angry": 3.5, "furious": 4.0,
+        "disappointed": 2.5, "useless": 3.0, "worst": 2.5, "waiting": 1.5, "ignored": 3.0,
+    },
+}
+
+# Negated positive words count as negative; negated negatives are only weakly positive
+NEGATIONS = {"not", "no", "never", "dont", "don't", "isnt", "isn't", "wasnt", "wasn't", "cannot", "can't", "won't", "didn't", "doesn't"}
+NEGATED_NEGATIVE_WEIGHT = 0.5
+
+# Auto-replies are common, unambiguous and not worth a model call
+AUTO_REPLY_PATTERN = re.compile(
+    r"out of (the )?office|automatic reply|auto-?reply|autoreply|away from (the )?office"
+    r"|on (annual |parental )?leave until|this is an automated (message|email|response)"
+    r"|do not reply to this (email|message)",
+    re.IGNORECASE
+)
+AUTO_REPLY_CONFIDENCE = 0.99
+
+_TOKEN_PATTERN = re.compile(r"[a-z']+")
+
+
+class Analyzer:
+    """Turns email text into {"sentiment", "tone", "engine", "confidence"} results."""
+
+    name = "base"
+
+    @property
+    def version(self) -> str:
+        # Part of the result cache key, results from different analyzers are never mixed up
+        return self.name
+
+    async def analyze(self, text: str) -> dict:
+        raise NotImplementedError
+
+    async def analyze_stream(self, text: str):
+        """Yields ("sentiment", label) and ("tone", label) as soon as each is known, then ("result", result)."""
+        yield "result", await self.analyze(text)
+
+    async def analyze_batch(self, texts: list, concurrency: int = 1) -> list:
+        """Results in input order; a failed email yields its exception instead of a result."""
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def analyze_one(text: str):
+            async with semaphore:
+                return await self.analyze(text)
+
+        return await asyncio.gather(*(analyze_one(text) for text in texts), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {}
+
+
+# The model must answer through this function, with labels from the fixed vocabulary
+ANALYSIS_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "record_analysis",
+        "description": "Record the sentiment and tone of an email.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "sentiment": {"type": "string", "enum": list(SENTIMENT_LABELS)},
+                "tone": {"type": "string", "enum": list(TONE_LABELS)},
+            },
+            "required": ["sentiment", "tone"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Fallback for answers that ignore the tool, e.g. "Sentiment: Positive\nTone: Friendly"
+_FALLBACK_PATTERN = re.compile(r"\b(sentiment|tone)\b[\s\"'*]*[:=\-][\s\"'*]*([A-Za-z][A-Za-z/\-]*)", re.IGNORECASE)
+
+
+class ParseStats:
+    """Counts how model answers were parsed, a rising fallback or failure rate means the prompt drifted."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.structured = 0
+        self.fallback = 0
+        self.failed = 0
+        self.unknown_labels = 0
+
+    def record(self, outcome: str, unknown_labels: int = 0):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            self.unknown_labels += unknown_labels
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.structured + self.fallback + self.failed
+            return {
+                "structured": self.structured,
+                "fallback": self.fallback,
+                "failed": self.failed,
+                "unknown_labels": self.unknown_labels,
+                "failure_ratio": self.failed / total if total else 0.0,
+            }
+
+
+parse_stats = ParseStats()
+
+
+def _structured_answer(message):
+    for tool_call in getattr(message, "tool_calls", None) or ():
+        if tool_call.function.name == ANALYSIS_TOOL["function"]["name"]:
+            return tool_call.function.arguments
+    content = (message.content or "").strip()
+    # Some models answer with the JSON object as plain content
+    if content.startswith("{"):
+        return content
+    return None
+
+
+def parse_model_output(message) -> dict:
+    """Validated JSON first, regex over free text second. Labels are always from the vocabulary or None."""
+    arguments = _structured_answer(message)
+    if arguments is not None:
+        try:
+            answer = json.loads(arguments)
+        except ValueError:
+            answer = None
+        if isinstance(answer, dict):
+            raw_sentiment, raw_tone = answer.get("sentiment"), answer.get("tone")
+            sentiment, tone = normalize_sentiment(raw_sentiment), normalize_tone(raw_tone)
+            if sentiment is not None and tone is not None:
+                parse_stats.record("structured")
+                return {"sentiment": sentiment, "tone": tone}
+
+    found = {}
+    for field, value in _FALLBACK_PATTERN.findall(message.content or ""):
+        found.setdefault(field.lower(), value)
+    sentiment = normalize_sentiment(found.get("sentiment"))
+    tone = normalize_tone(found.get("tone"))
+    unknown = sum(1 for field, label in (("sentiment", sentiment), ("tone", tone)) if field in found and label is None)
+    parse_stats.record("fallback" if sentiment is not None or tone is not None else "failed", unknown)
+    return {"sentiment": sentiment, "tone": tone}
+
+
+class StreamedAnswer:
+    """Assembles a streamed completion and reports each label as soon as its value is complete."""
+
+    _JSON_LABEL = re.compile(r'"(sentiment|tone)"\s*:\s*"([^"]*)"')
+
+    def __init__(self):
+        self.tool_name = None
+        self.arguments = ""
+        self.content = ""
+        self.known = {}
+
+    def feed(self, chunk) -> list:
+        """Takes one completion chunk, returns the (field, label) pairs it completed."""
+        for choice in chunk.choices:
+            delta = choice.delta
+            for tool_call in delta.tool_calls or ():
+                if tool_call.function is None:
+                    continue
+                if tool_call.function.name:
+                    self.tool_name = tool_call.function.name
+                self.arguments += tool_call.function.arguments or ""
+            self.content += delta.content or ""
+        return self._new_labels(final=False)
+
+    def finish(self) -> list:
+        return self._new_labels(final=True)
+
+    def _new_labels(self, final: bool) -> list:
+        candidates = self._JSON_LABEL.findall(self.arguments)
+        if self.content.lstrip().startswith("{"):
+            candidates += self._JSON_LABEL.findall(self.content)
+        else:
+            for match in _FALLBACK_PATTERN.finditer(self.content):
+                # "Tone: Friend" may still become "Friendly", wait for the character after the word
+                if final or match.end() < len(self.content):
+                    candidates.append(match.groups())
+        labels = []
+        for field, value in candidates:
+            field = field.lower()
+            if field in self.known:
+                continue
+            label = normalize_sentiment(value) if field == "sentiment" else normalize_tone(value)
+            if label is not None:
+                self.known[field] = label
+                labels.append((field, label))
+        return labels
+
+    def message(self):
+        # Same shape as a non-streamed message, so the final answer goes through parse_model_output
+        tool_calls = []
+        if self.tool_name is not None:
+            tool_calls.append(SimpleNamespace(function=SimpleNamespace(name=self.tool_name, arguments=self.arguments)))
+        return SimpleNamespace(content=self.content or None, tool_calls=tool_calls)
+
+
+def _analysis_request(text: str) -> dict:
+    prompt = f"Analyze the following email for sentiment and tone.\n\nEmail:\n{text}"
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "tools": [ANALYSIS_TOOL],
+        "tool_choice": {"type": "function", "function": {"name": ANALYSIS_TOOL["function"]["name"]}},
+        "max_tokens": 50,
+    }
+
+
+async def run_model_analysis(text: str) -> dict:
+    with metrics.stage("llm"):
+        response = await llm.chat_completion(**_analysis_request(text))
+    with metrics.stage("parse"):
+        return parse_model_output(response.choices[0].message)
+
+
+async def stream_model_analysis(text: str):
+    """Yields (field, label) pairs while the answer streams in, then ("result", labels) parsed like run_model_analysis."""
+    answer = StreamedAnswer()
+    with metrics.stage("llm"):
+        async for chunk in llm.chat_completion_stream(**_analysis_request(text)):
+            for label in answer.feed(chunk):
+                yield label
+    for label in answer.finish():
+        yield label
+    with metrics.stage("parse"):
+        yield "result", parse_model_output(answer.message())
+
+
+class OpenAIAnalyzer(Analyzer):
+    name = "openai"
+
+    @property
+    def version(self) -> str:
+        return f"openai:{OPENAI_MODEL}:{PROMPT_VERSION}"
+
+    async def analyze(self, text: str) -> dict:
+        result = await run_model_analysis(text)
+        return {**result, "engine": self.name, "confidence": None}
+
+    async def analyze_stream(self, text: str):
+        async for kind, value in stream_model_analysis(text):
+            if kind == "result":
+                value = {**value, "engine": self.name, "confidence": None}
+            yield kind, value
+
+    def stats(self) -> dict:
+        return {"parse": parse_stats.stats()}
+
+
+def _softmax(scores: np.ndarray) -> np.ndarray:
+    scores = scores - scores.max(axis=1, keepdims=True)
+    exp = np.exp(scores)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class LocalAnalyzer(Analyzer):
+    """Bag-of-words linear model over LEXICON, scored for a whole batch with one matrix product."""
+
+    name = "local"
+    model_version = "2"
+
+    def __init__(self, lexicon: dict = LEXICON, max_tokens: int = LOCAL_MAX_TOKENS):
+        self.max_tokens = max_tokens
+        words = set()
+        for weights in lexicon.values():
+            words.update(weights)
+        negated = {"not_" + word for word in lexicon["Positive"]} | {"not_" + word for word in lexicon["Negative"]}
+        self._vocabulary = {word: index for index, word in enumerate(sorted(words | negated))}
+        self._sentiment_weights = np.zeros((len(self._vocabulary), len(SENTIMENT_LABELS)))
+        self._tone_weights = np.zeros((len(self._vocabulary), len(TONE_LABELS)))
+        for label, weights in lexicon.items():
+            for word, weight in weights.items():
+                if label in SENTIMENT_LABELS:
+                    self._sentiment_weights[self._vocabulary[word], SENTIMENT_LABELS.index(label)] = weight
+                else:
+                    self._tone_weights[self._vocabulary[word], TONE_LABELS.index(label)] = weight
+        positive = SENTIMENT_LABELS.index("Positive")
+        negative = SENTIMENT_LABELS.index("Negative")
+        for word, weight in lexicon["Positive"].items():
+            self._sentiment_weights[self._vocabulary["not_" + word], negative] = weight
+        for word, weight in lexicon["Negative"].items():
+            self._sentiment_weights[self._vocabulary["not_" + word], positive] = weight * NEGATED_NEGATIVE_WEIGHT
+        # Praise next to complaints is usually sarcasm ("Great, another outage. Thanks a lot.")
+        self._praise = self._sentiment_weights[:, positive] > 0
+        complaint_tones = [TONE_LABELS.index("Urgent"), TONE_LABELS.index("Frustrated")]
+        self._complaint = (self._sentiment_weights[:, negative] > 0) | (self._tone_weights[:, complaint_tones] > 0).any(axis=1)
+        # Small prior towards Neutral, so an email with no evidence stays below the threshold
+        self._sentiment_bias = np.array([0.5 if label == "Neutral" else 0.0 for label in SENTIMENT_LABELS])
+        self._tone_bias = np.array([0.5 if label == "Neutral" else 0.0 for label in TONE_LABELS])
+
+    @property
+    def version(self) -> str:
+        return f"local:{self.model_version}:{self.max_tokens}"
+
+    def _features(self, text: str):
+        tokens = _TOKEN_PATTERN.findall(text.lower())
+        indices = []
+        negate = False
+        for token in tokens:
+            token = token.strip("'")
+            if token in NEGATIONS:
+                negate = True
+                continue
+            index = self._vocabulary.get("not_" + token if negate else token)
+            if index is not None:
+                indices.append(index)
+            negate = False
+        return len(tokens), indices
+
+    def score(self, texts: list) -> list:
+        """Synchronous batched scoring, cheap enough to run on the event loop for a request's worth of emails."""
+        features = [self._features(text) for text in texts]
+        counts = np.zeros((len(texts), len(self._vocabulary)))
+        rows = np.repeat(np.arange(len(texts)), [len(indices) for _, indices in features])
+        columns = np.fromiter((index for _, indices in features for index in indices), dtype=np.intp, count=len(rows))
+        np.add.at(counts, (rows, columns), 1)
+        # Repeating a word does not make an email more certain
+        np.minimum(counts, 2, out=counts)
+        sentiment = _softmax(counts @ self._sentiment_weights + self._sentiment_bias)
+        tone = _softmax(counts @ self._tone_weights + self._tone_bias)
+        confidence = np.minimum(sentiment.max(axis=1), tone.max(axis=1))
+        # Mixed signals always escalate, the lexicon cannot tell sarcasm from a polite complaint
+        mixed = (counts[:, self._praise].sum(axis=1) > 0) & (counts[:, self._complaint].sum(axis=1) > 0)
+        confidence[mixed] = 0.0
+        sentiment_labels = sentiment.argmax(axis=1)
+        tone_labels = tone.argmax(axis=1)
+
+        results = []
+        for row, (text, (token_count, _)) in enumerate(zip(texts, features)):
+            if AUTO_REPLY_PATTERN.search(text):
+                results.append({
+                    "sentiment": "Neutral",
+                    "tone": "Formal",
+                    "engine": self.name,
+                    "confidence": AUTO_REPLY_CONFIDENCE,
+                })
+                continue
+            results.append({
+                "sentiment": SENTIMENT_LABELS[sentiment_labels[row]],
+                "tone": TONE_LABELS[tone_labels[row]],
+                "engine": self.name,
+                "confidence": 0.0 if token_count > self.max_tokens else round(float(confidence[row]), 4),
+            })
+        return results
+
+    async def analyze(self, text: str) -> dict:
+        with metrics.stage("local_model"):
+            return self.score([text])[0]
+
+    async def analyze_batch(self, texts: list, concurrency: int = 1) -> list:
+        with metrics.stage("local_model"):
+            return self.score(texts)
+
+
+class TieredAnalyzer(Analyzer):
+    """Local model first, escalating only low-confidence emails to the remote analyzer."""
+
+    name = "tiered"
+
+    def __init__(self, local: Analyzer, remote: Analyzer, threshold: float):
+        self.local = local
+        self.remote = remote
+        self.threshold = threshold
+        self.local_results = 0
+        self.escalated = 0
+
+    @property
+    def version(self) -> str:
+        return f"tiered:{self.threshold}:{self.local.version}:{self.remote.version}"
+
+    async def analyze(self, text: str) -> dict:
+        result = await self.local.analyze(text)
+        if result["confidence"] >= self.threshold:
+            self.local_results += 1
+            return result
+        self.escalated += 1
+        return await self.remote.analyze(text)
+
+    async def analyze_stream(self, text: str):
+        result = await self.local.analyze(text)
+        if result["confidence"] >= self.threshold:
+            self.local_results += 1
+            yield "result", result
+            return
+        self.escalated += 1
+        async for event in self.remote.analyze_stream(text):
+            yield event
+
+    async def analyze_batch(self, texts: list, concurrency: int = 1) -> list:
+        results = await self.local.analyze_batch(texts, concurrency)
+        escalate = [
+            index for index, result in enumerate(results)
+            if isinstance(result, BaseException) or result["confidence"] < self.threshold
+        ]
+        self.local_results += len(texts) - len(escalate)
+        self.escalated += len(escalate)
+        if escalate:
+            remote_results = await self.remote.analyze_batch([texts[index] for index in escalate], concurrency)
+            for index, result in zip(escalate, remote_results):
+                results[index] = result
+        return results
+
+    def stats(self) -> dict:
+        total = self.local_results + self.escalated
+        return {
+            "threshold": self.threshold,
+            "local": self.local_results,
+            "escalated": self.escalated,
+            "local_ratio": self.local_results / total if total else 0.0,
+            **self.remote.stats(),
+        }
+
+
+def build_analyzer(name: str) -> Analyzer:
+    if name == "openai":
+        return OpenAIAnalyzer()
+    if name == "local":
+        return LocalAnalyzer()
+    if name == "tiered":
+        return TieredAnalyzer(LocalAnalyzer(), OpenAIAnalyzer(), LOCAL_CONFIDENCE_THRESHOLD)
+    raise ValueError(f"Unknown ANALYZER {name!r}, expected openai, local or tiered")
+
+
+analyzer = build_analyzer(ANALYZER)
@@ -1,39 +1,60 @@
 from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app import models
 from app.database import get_db
-import os
+from app.principals import Principal, principal_cache
+from app import metrics, passwords
+from app.settings import get_settings
 from datetime import datetime, timedelta
-from passlib.context import CryptContext
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing (bcrypt runs on a dedicated process pool, see app/passwords.py)
+pwd_context = passwords.pwd_context
 
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="users/loging")
 
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+async def _run_password_job(fn, *args):
+    try:
+        with metrics.password_seconds.time(operation=fn.__name__):
+            return await fn(*args)
+    except passwords.PasswordPoolBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many password operations in progress, please retry shortly",
+            headers={"Retry-After": "1"},
+        )
+    except passwords.PasswordTimeout:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Password operation timed out, please retry shortly",
+            headers={"Retry-After": "1"},
+        )
+
+async def verify_password(plain_password, hashed_password):
+    return (await verify_and_update_password(plain_password, hashed_password))[0]
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_and_update_password(plain_password, hashed_password):
+    # Returns (valid, new_hash), new_hash is set when the stored hash is deprecated
+    return await _run_password_job(passwords.verify_and_update, plain_password, hashed_password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await _run_password_job(passwords.hash_password, password)
 
 def create_access_token(data: dict):
+    settings = get_settings()
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    expire = datetime.utcnow() + timedelta(minutes=settings.access_token_expire_minutes)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, settings.secret_key, algorithm=settings.algorithm)
     return encoded_jwt
 
 def decode_access_token(token: str):
+    settings = get_settings()
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
         return payload
     except JWTError:
         raise HTTPException(
@@ -42,22 +63,34 @@ def decode_access_token(token: str):
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    with metrics.stage("auth"):
+        return await _authenticate(token, db)
+
+async def _authenticate(token: str, db: AsyncSession):
+    # Cached principals skip both the JWT decode and the users lookup
+    principal = principal_cache.get(token)
+    if principal is not None:
+        return principal
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    settings = get_settings()
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
     
-    user = db.query(models.User).filter(models.User.username == username).first()
+    result = await db.execute(select(models.User).where(models.User.username == username))
+    user = result.scalars().first()
     if user is None:
         raise credentials_exception
     
-    return user
\ No newline at end of file
+    principal = Principal.from_user(user)
+    principal_cache.set(token, principal, payload.get("exp"))
+    return principal
\ No newline at end of file
@@ -0,0 +1,25 @@
+import argparse
+import asyncio
+
+from app import database, models
+
+
+async def create_schema() -> list:
+    """Creates missing tables and indexes. Existing tables are left as they are, see the README for column changes."""
+    try:
+        async with database.get_engine().begin() as conn:
+            await conn.run_sync(models.Base.metadata.create_all)
+        return sorted(models.Base.metadata.tables)
+    finally:
+        await database.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepare the database before the first deploy or after a model change.")
+    parser.parse_args()
+    tables = asyncio.run(create_schema())
+    print(f"Schema ready, {len(tables)} tables: {', '.join(tables)}")
+
+
+if __name__ == "__main__":
+    main()
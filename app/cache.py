@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import database, models
+
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "10000"))
+ANALYSIS_CACHE_TTL_SECONDS = int(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", "86400"))
+# Persistent tier is opt-in, it costs one indexed lookup per in-memory miss
+ANALYSIS_CACHE_PERSIST = os.getenv("ANALYSIS_CACHE_PERSIST", "false").lower() in ("1", "true", "yes")
+# Entries per upsert statement (6 columns each)
+ANALYSIS_CACHE_UPSERT_CHUNK = 150
+# Keys per IN (...) list when looking up a batch
+ANALYSIS_CACHE_LOOKUP_CHUNK = 500
+# Stored in their own columns, everything else in a result (long-input metadata) goes to details
+LABEL_FIELDS = ("sentiment", "tone", "engine")
+
+
+def normalize_email_text(text: str) -> str:
+    # Same email re-sent with different line endings or trailing blanks should hit
+    text = unicodedata.normalize("NFC", text).replace("\r\n", "\n").replace("\r", "\n")
+    lines = [" ".join(line.split()) for line in text.split("\n")]
+    return "\n".join(lines).strip()
+
+
+def make_cache_key(email_text: str, analyzer_version: str) -> str:
+    digest = hashlib.sha256()
+    digest.update(f"{analyzer_version}\x00".encode("utf-8"))
+    digest.update(normalize_email_text(email_text).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def persistent_entry(key: str, value: dict) -> dict:
+    details = {name: item for name, item in value.items() if name not in LABEL_FIELDS}
+    return {
+        "key": key,
+        "sentiment": value.get("sentiment"),
+        "tone": value.get("tone"),
+        "engine": value.get("engine"),
+        "details": json.dumps(details) if details else None,
+        "created_at": datetime.utcnow(),
+    }
+
+
+async def upsert_entries(db: AsyncSession, entries: list):
+    """Writes (key, result) pairs to analysis_cache, committed by the caller.
+
+    INSERT .. ON CONFLICT, so two requests that missed on the same email both succeed instead of
+    the second failing on the primary key."""
+    # Last result per key, one statement may not update the same row twice
+    rows = list({key: persistent_entry(key, value) for key, value in entries}.values())
+    insert = database.upsert(db.get_bind().dialect.name)
+    for start in range(0, len(rows), ANALYSIS_CACHE_UPSERT_CHUNK):
+        statement = insert(models.AnalysisCacheEntry).values(rows[start:start + ANALYSIS_CACHE_UPSERT_CHUNK])
+        await db.execute(statement.on_conflict_do_update(
+            index_elements=["key"],
+            set_={name: statement.excluded[name] for name in ("sentiment", "tone", "engine", "details", "created_at")}
+        ))
+
+
+class AnalysisCache:
+    """In-process LRU of analysis results with TTL, backed by an optional DB tier."""
+
+    def __init__(self, max_size: int, ttl_seconds: int, persist: bool = False):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.persist = persist
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_seconds = 0.0
+        # Moving average of upstream latency, used to estimate time saved per hit
+        self._avg_miss_seconds = 0.0
+
+    async def get(self, key: str, db: AsyncSession = None):
+        value = self._get_memory(key)
+        if value is not None:
+            return value
+
+        if self.persist and db is not None:
+            value = await self._get_persistent(key, db)
+            if value is not None:
+                self._set_memory(key, value)
+                with self._lock:
+                    self.persistent_hits += 1
+                    self.saved_seconds += self._avg_miss_seconds
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    async def get_many(self, keys: list, db: AsyncSession = None) -> dict:
+        """key -> result for the keys found, with one query for all the in-memory misses."""
+        found = {}
+        missing = []
+        for key in keys:
+            value = self._get_memory(key)
+            if value is not None:
+                found[key] = value
+            else:
+                missing.append(key)
+
+        if self.persist and db is not None and missing:
+            stored = await self._get_persistent_many(missing, db)
+            for key, value in stored.items():
+                self._set_memory(key, value)
+            found.update(stored)
+            with self._lock:
+                self.persistent_hits += len(stored)
+                self.saved_seconds += self._avg_miss_seconds * len(stored)
+            missing = [key for key in missing if key not in stored]
+
+        with self._lock:
+            self.misses += len(missing)
+        return found
+
+    async def set(self, key: str, value: dict, db: AsyncSession = None, elapsed: float = None):
+        self._set_memory(key, value)
+        if elapsed is not None:
+            with self._lock:
+                if self._avg_miss_seconds == 0.0:
+                    self._avg_miss_seconds = elapsed
+                else:
+                    self._avg_miss_seconds = 0.9 * self._avg_miss_seconds + 0.1 * elapsed
+        if self.persist and db is not None:
+            # In the caller's transaction so it commits with the analysis row
+            await upsert_entries(db, [(key, value)])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.persistent_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl_seconds,
+                "persistent": self.persist,
+                "hits": self.hits,
+                "persistent_hits": self.persistent_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": (self.hits + self.persistent_hits) / lookups if lookups else 0.0,
+                "avg_upstream_seconds": self._avg_miss_seconds,
+                "estimated_saved_seconds": self.saved_seconds,
+            }
+
+    def _get_memory(self, key: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += self._avg_miss_seconds
+            return value
+
+    def _set_memory(self, key: str, value: dict):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    async def _get_persistent(self, key: str, db: AsyncSession):
+        row = await db.get(models.AnalysisCacheEntry, key)
+        if row is None:
+            return None
+        if row.created_at < datetime.utcnow() - timedelta(seconds=self.ttl_seconds):
+            return None
+        return self._from_row(row)
+
+    async def _get_persistent_many(self, keys: list, db: AsyncSession) -> dict:
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl_seconds)
+        found = {}
+        for start in range(0, len(keys), ANALYSIS_CACHE_LOOKUP_CHUNK):
+            result = await db.execute(
+                select(models.AnalysisCacheEntry)
+                .where(models.AnalysisCacheEntry.key.in_(keys[start:start + ANALYSIS_CACHE_LOOKUP_CHUNK]))
+                .where(models.AnalysisCacheEntry.created_at >= cutoff)
+            )
+            for row in result.scalars():
+                found[row.key] = self._from_row(row)
+        return found
+
+    @staticmethod
+    def _from_row(row) -> dict:
+        value = json.loads(row.details) if row.details else {}
+        value.update(sentiment=row.sentiment, tone=row.tone, engine=row.engine)
+        return value
+
+
+analysis_cache = AnalysisCache(
+    max_size=ANALYSIS_CACHE_SIZE,
+    ttl_seconds=ANALYSIS_CACHE_TTL_SECONDS,
+    persist=ANALYSIS_CACHE_PERSIST
+)
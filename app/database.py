@@ -1,30 +1,107 @@
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from dotenv import load_dotenv
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from app import metrics
+from app.settings import get_settings
+import logging
 import os
+import time
 
-load_dotenv()
+# Connection pool tuning (ignored for SQLite)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "10"))
+DB_POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() in ("1", "true", "yes")
 
-# Get database URL from environment variable or set it directly
-DATABASE_URL = os.getenv("DATABASE_URL")
+def async_database_url(url: str) -> str:
+    # Accept the usual sync URLs and pick the matching async driver
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    if url.startswith("postgresql+psycopg2://"):
+        url = "postgresql://" + url[len("postgresql+psycopg2://"):]
+    if url.startswith("postgresql://"):
+        return "postgresql+asyncpg://" + url[len("postgresql://"):]
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url[len("sqlite://"):]
+    return url
 
-engine = create_engine(
-    DATABASE_URL,
-    echo=False,  # Set to False in production
-    pool_pre_ping=True,
-    # Add this line to explicitly specify the PostgreSQL dialect
-    connect_args={"options": "-c timezone=utc"}
-)
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long each checkout waited, including connecting."""
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.db_checkout_seconds.observe(time.perf_counter() - started)
+
+# The pool logs under this module's name; keep its chatter at SQLAlchemy's usual level, not the app's
+logging.getLogger(f"{__name__}.{InstrumentedPool.__name__}").setLevel(logging.WARNING)
+
+def engine_options(url: str) -> dict:
+    if url.startswith("sqlite"):
+        # SQLite via aiosqlite is meant for local runs and load tests
+        if ":memory:" in url:
+            return {"echo": DB_ECHO}
+        return {"echo": DB_ECHO, "poolclass": InstrumentedPool}
+    return {
+        "echo": DB_ECHO,  # Set to False in production
+        "poolclass": InstrumentedPool,
+        "pool_pre_ping": True,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT_SECONDS,
+        "pool_recycle": DB_POOL_RECYCLE_SECONDS,
+        "connect_args": {
+            "server_settings": {
+                "timezone": "utc",
+                "statement_timeout": str(DB_STATEMENT_TIMEOUT_MS),
+            }
+        },
+    }
+
+# Built on first use, so importing the app never touches the database or its driver
+_engine = None
+_sessionmaker = None
+
+def get_engine():
+    global _engine, _sessionmaker
+    if _engine is None:
+        database_url = get_settings().database_url
+        if not database_url:
+            raise RuntimeError("DATABASE_URL is not set")
+        url = async_database_url(database_url)
+        _engine = create_async_engine(url, **engine_options(url))
+        # expire_on_commit=False so committed objects can still be read without another round-trip
+        _sessionmaker = async_sessionmaker(_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+    return _engine
+
+def session() -> AsyncSession:
+    get_engine()
+    return _sessionmaker()
+
+async def dispose():
+    global _engine, _sessionmaker
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = None
+        _sessionmaker = None
 
 Base = declarative_base()
 
-# Dependency for FastAPI routes
-def get_db():
-    db = SessionLocal()
-    try:
+def upsert(dialect_name: str):
+    # INSERT .. ON CONFLICT for the dialects we run on, used for counters maintained in place
+    if dialect_name == "postgresql":
+        return postgresql_insert
+    if dialect_name == "sqlite":
+        return sqlite_insert
+    raise RuntimeError(f"INSERT .. ON CONFLICT is not supported on {dialect_name}")
+
+# Dependency for FastAPI routes, shared by every router
+async def get_db():
+    async with session() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
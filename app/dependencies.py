@@ -4,14 +4,24 @@ from jose import JWTError
 from app.auth import decode_access_token
 from app.models import User
 from app.database import get_db
-from sqlalchemy.orm import Session
+from app.principals import Principal, principal_cache
+from app import metrics
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/users/loging")
 
-def get_current_user(
+async def get_current_user(
     token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
+    with metrics.stage("auth"):
+        return await _authenticate(token, db)
+
+async def _authenticate(token: str, db: AsyncSession):
+    principal = principal_cache.get(token)
+    if principal is not None:
+        return principal
     try:
         payload = decode_access_token(token)
         username: str = payload.get("sub")
@@ -21,10 +31,13 @@ def get_current_user(
                 detail="Invalid authentication credentials",
                 headers={"WWW-Authenticate": "Bearer"},
             )
-        user = db.query(User).filter(User.username == username).first()
+        result = await db.execute(select(User).where(User.username == username))
+        user = result.scalars().first()
         if user is None:
             raise HTTPException(status_code=404, detail="User not found")
-        return user
+        principal = Principal.from_user(user)
+        principal_cache.set(token, principal, payload.get("exp"))
+        return principal
     except JWTError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
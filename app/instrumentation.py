@@ -0,0 +1,43 @@
+import time
+
+from app import metrics
+
+
+def route_template(scope) -> str:
+    """Path with parameters put back as {name}, or "unmatched" so unknown URLs cannot grow the label set."""
+    if scope.get("route") is None:
+        return "unmatched"
+    # The matched route object does not carry the include_router prefix on every FastAPI version,
+    # so start from the request path and substitute the parameter values
+    segments = scope["path"].split("/")
+    names = {str(value): name for name, value in scope.get("path_params", {}).items()}
+    return "/".join("{" + names[segment] + "}" if segment in names else segment for segment in segments)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status and in-flight count per route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        metrics.http_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            metrics.http_in_flight.dec()
+            route_path = route_template(scope)
+            method = scope["method"]
+            metrics.http_request_seconds.observe(time.perf_counter() - started, method=method, route=route_path)
+            metrics.http_requests.inc(method=method, route=route_path, status=status["code"])
@@ -0,0 +1,91 @@
+import re
+
+from sqlalchemy import SmallInteger
+from sqlalchemy.types import TypeDecorator
+
+# Fixed label vocabulary. Codes are what gets stored, never renumber an existing label.
+SENTIMENT_CODES = {"Positive": 1, "Negative": 2, "Neutral": 3}
+TONE_CODES = {"Friendly": 1, "Formal": 2, "Urgent": 3, "Frustrated": 4, "Neutral": 5}
+
+SENTIMENT_LABELS = tuple(SENTIMENT_CODES)
+TONE_LABELS = tuple(TONE_CODES)
+
+# Code 0 stands for "no label" where a NULL is not allowed (rollup keys)
+MISSING_CODE = 0
+
+# Free-form answers we have seen from the model, mapped onto the vocabulary
+SENTIMENT_SYNONYMS = {
+    "pos": "Positive", "good": "Positive", "happy": "Positive", "satisfied": "Positive",
+    "neg": "Negative", "bad": "Negative", "unhappy": "Negative", "dissatisfied": "Negative",
+    "neutral/mixed": "Neutral", "mixed": "Neutral", "none": "Neutral", "objective": "Neutral",
+}
+TONE_SYNONYMS = {
+    "warm": "Friendly", "casual": "Friendly", "informal": "Friendly", "cheerful": "Friendly",
+    "polite": "Formal", "professional": "Formal", "businesslike": "Formal", "courteous": "Formal",
+    "pressing": "Urgent", "demanding": "Urgent", "time-sensitive": "Urgent",
+    "angry": "Frustrated", "annoyed": "Frustrated", "irritated": "Frustrated", "upset": "Frustrated",
+    "impatient": "Frustrated", "informative": "Neutral", "matter-of-fact": "Neutral", "factual": "Neutral",
+}
+
+_SENTIMENT_LOOKUP = {**SENTIMENT_SYNONYMS, **{label.lower(): label for label in SENTIMENT_LABELS}}
+_TONE_LOOKUP = {**TONE_SYNONYMS, **{label.lower(): label for label in TONE_LABELS}}
+_LABEL_WORD = re.compile(r"[a-z][a-z/\-]*")
+
+
+def _normalize(value, labels: tuple, lookup: dict):
+    if value is None:
+        return None
+    if value in labels:
+        return value
+    key = str(value).strip().strip(".,;:!\"'*`").lower()
+    if key in lookup:
+        return lookup[key]
+    # "Positive, but cautious" -> Positive
+    match = _LABEL_WORD.match(key)
+    if match is not None:
+        return lookup.get(match.group(0))
+    return None
+
+
+def normalize_sentiment(value):
+    """Maps a model answer onto SENTIMENT_LABELS, None when it cannot be placed."""
+    return _normalize(value, SENTIMENT_LABELS, _SENTIMENT_LOOKUP)
+
+
+def normalize_tone(value):
+    """Maps a model answer onto TONE_LABELS, None when it cannot be placed."""
+    return _normalize(value, TONE_LABELS, _TONE_LOOKUP)
+
+
+class LabelCode(TypeDecorator):
+    """Stores a vocabulary label as a SMALLINT code and loads it back as the label string."""
+
+    impl = SmallInteger
+    cache_ok = True
+
+    def __init__(self, codes: dict, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Hashable copy, SQLAlchemy builds the statement cache key from it
+        self.codes = tuple(codes.items())
+        self._codes = dict(codes)
+        self._labels = {code: label for label, code in codes.items()}
+        self._lookup = {label.lower(): label for label in codes}
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if value == "":
+            return MISSING_CODE
+        code = self._codes.get(value)
+        if code is None:
+            # Case-insensitive so ?sentiment=positive still matches. Anything outside the
+            # vocabulary binds as NULL: stored as no label, and "= NULL" never matches in a filter.
+            code = self._codes.get(self._lookup.get(str(value).strip().lower()))
+        return code
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if value == MISSING_CODE:
+            return ""
+        return self._labels.get(value)
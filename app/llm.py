@@ -0,0 +1,113 @@
+import asyncio
+import importlib
+import os
+import time
+
+import httpx
+
+from app import metrics
+
+
+# Connection pool and timeout tuning for the shared OpenAI client
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY_SECONDS", "60"))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "30"))
+OPENAI_CONNECT_TIMEOUT_SECONDS = float(os.getenv("OPENAI_CONNECT_TIMEOUT_SECONDS", "5"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+# Upper bound on concurrent upstream requests across the whole process
+OPENAI_MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", "64"))
+# Import the SDK in the background right after startup instead of on the first upstream call.
+# Saves the first analysis about half a second, at the cost of slower requests while it runs.
+OPENAI_PRELOAD = os.getenv("OPENAI_PRELOAD", "false").lower() in ("1", "true", "yes")
+
+_client = None
+# The SDK module once imported; it is the slowest import of the app, so it is loaded on first use
+_openai = None
+_in_flight = asyncio.Semaphore(OPENAI_MAX_IN_FLIGHT)
+
+
+def _build_client():
+    import openai
+
+    return openai.AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS),
+        max_retries=OPENAI_MAX_RETRIES,
+        http_client=openai.DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY_SECONDS
+            )
+        )
+    )
+
+
+async def _load_openai():
+    global _openai
+    if _openai is None:
+        # Off the event loop, other requests keep being served while it imports
+        _openai = await asyncio.to_thread(importlib.import_module, "openai")
+    return _openai
+
+
+async def warm_up():
+    if OPENAI_PRELOAD:
+        await _load_openai()
+
+
+async def shutdown():
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+def get_client():
+    # One pooled client for the lifetime of the process, built on first use
+    global _client
+    if _client is None:
+        _client = _build_client()
+    return _client
+
+
+async def chat_completion(**kwargs):
+    openai = await _load_openai()
+    async with _in_flight:
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = await get_client().chat.completions.create(**kwargs)
+            status = 200
+            return response
+        except openai.APIStatusError as e:
+            status = e.status_code
+            raise
+        finally:
+            metrics.upstream_seconds.observe(time.perf_counter() - started, service="openai")
+            metrics.upstream_requests.inc(service="openai", status=status)
+
+
+async def chat_completion_stream(**kwargs):
+    """Yields the chunks of a streamed completion; the in-flight slot is held until the stream ends or is closed."""
+    openai = await _load_openai()
+    async with _in_flight:
+        started = time.perf_counter()
+        status = "error"
+        try:
+            stream = await get_client().chat.completions.create(stream=True, **kwargs)
+            status = 200
+            first = True
+            async with stream:
+                async for chunk in stream:
+                    if first:
+                        metrics.upstream_first_chunk_seconds.observe(time.perf_counter() - started, service="openai")
+                        first = False
+                    yield chunk
+        except openai.APIStatusError as e:
+            status = e.status_code
+            raise
+        finally:
+            metrics.upstream_seconds.observe(time.perf_counter() - started, service="openai")
+            metrics.upstream_requests.inc(service="openai", status=status)
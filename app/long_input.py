@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import math
+import os
+import re
+from collections import Counter
+
+from app.analyzers import OPENAI_MODEL, Analyzer
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:  # optional, token counts fall back to an estimate
+    tiktoken = None
+
+# Emails above this many tokens are cleaned up and analyzed in chunks of this size
+LONG_INPUT_CHUNK_TOKENS = int(os.getenv("LONG_INPUT_CHUNK_TOKENS", "1500"))
+# Tokens analyzed per email unless the request asks for another budget
+LONG_INPUT_TOKEN_BUDGET = int(os.getenv("LONG_INPUT_TOKEN_BUDGET", "6000"))
+LONG_INPUT_MAX_TOKEN_BUDGET = int(os.getenv("LONG_INPUT_MAX_TOKEN_BUDGET", "32000"))
+# Chunks of one email analyzed at once
+LONG_INPUT_CONCURRENCY = int(os.getenv("LONG_INPUT_CONCURRENCY", "8"))
+
+# Rough English average, used when the tiktoken encoding is not loaded
+CHARS_PER_TOKEN = 4
+
+_QUOTE_HEADER = re.compile(
+    r"^(on .+ wrote:|-{2,}\s*original message\s*-{2,}|-{2,}\s*forwarded message\s*-{2,}|from:\s.+)$",
+    re.IGNORECASE
+)
+_SIGNATURE_START = re.compile(r"^(--|sent from my \w+.*|get outlook for \w+.*)$", re.IGNORECASE)
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+# Loaded by warm_up only, requests never fetch it
+_encoding = None
+# Set once loading failed, counts stay estimated until restart instead of retrying the download
+_encoding_failed = False
+
+
+def _load_encoding():
+    try:
+        return tiktoken.encoding_for_model(OPENAI_MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+async def warm_up():
+    # tiktoken downloads its encoding on first use (cached in TIKTOKEN_CACHE_DIR); done off the loop at startup
+    global _encoding, _encoding_failed
+    if tiktoken is None or _encoding is not None or _encoding_failed:
+        return
+    try:
+        _encoding = await asyncio.to_thread(_load_encoding)
+    except Exception as e:
+        _encoding_failed = True
+        logger.warning("Could not load the tiktoken encoding, token counts are estimated", extra={"error": str(e)})
+
+
+def count_tokens(text: str) -> int:
+    # Estimated until warm_up has loaded the encoding, and for good if it could not
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def is_long(text: str, chunk_tokens: int = LONG_INPUT_CHUNK_TOKENS) -> bool:
+    # A token is at least one character, so short texts skip counting entirely
+    if len(text) <= chunk_tokens:
+        return False
+    return count_tokens(text) > chunk_tokens
+
+
+def strip_quoted(text: str) -> str:
+    """Drops quoted replies, forwarded/original message blocks and the signature of the newest message."""
+    kept = []
+    for line in text.replace("\r\n", "\n").split("\n"):
+        stripped = line.strip()
+        if _QUOTE_HEADER.match(stripped):
+            # Everything below a reply header is the earlier thread
+            break
+        if _SIGNATURE_START.match(stripped) and kept:
+            break
+        if stripped.startswith(">"):
+            continue
+        kept.append(line)
+    cleaned = "\n".join(kept).strip()
+    # Never throw the whole email away, e.g. a forward with no text of its own
+    return cleaned or text.strip()
+
+
+def _split_long_paragraph(paragraph: str, chunk_tokens: int):
+    pieces = []
+    for sentence in _SENTENCE_END.split(paragraph):
+        if count_tokens(sentence) <= chunk_tokens:
+            pieces.append(sentence)
+            continue
+        # A single run-on sentence, fall back to fixed-size word windows
+        words = sentence.split()
+        step = max(1, len(words) * chunk_tokens // max(1, count_tokens(sentence)))
+        pieces.extend(" ".join(words[start:start + step]) for start in range(0, len(words), step))
+    return pieces
+
+
+def split_chunks(text: str, chunk_tokens: int = LONG_INPUT_CHUNK_TOKENS):
+    """Packs paragraphs (then sentences) into chunks of at most chunk_tokens. Returns (chunk, tokens) pairs."""
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if count_tokens(paragraph) <= chunk_tokens:
+            pieces.append(paragraph)
+        else:
+            pieces.extend(_split_long_paragraph(paragraph, chunk_tokens))
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    for piece in pieces:
+        tokens = count_tokens(piece)
+        if current and current_tokens + tokens > chunk_tokens:
+            chunks.append(("\n\n".join(current), current_tokens))
+            current = []
+            current_tokens = 0
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        chunks.append(("\n\n".join(current), current_tokens))
+    return chunks
+
+
+def _vote(chunks: list, label: str):
+    # Each chunk votes with its token count, ties go to the earliest (newest) text
+    weights = Counter()
+    for chunk in chunks:
+        if chunk[label] is not None:
+            weights[chunk[label]] += chunk["tokens"]
+    if not weights:
+        return None, 0.0
+    winner = max(weights, key=weights.get)
+    return winner, weights[winner] / sum(weights.values())
+
+
+def merge_chunk_results(chunks: list) -> dict:
+    sentiment, sentiment_share = _vote(chunks, "sentiment")
+    tone, tone_share = _vote(chunks, "tone")
+    engines = sorted({chunk["engine"] for chunk in chunks if chunk["engine"]})
+    return {
+        "sentiment": sentiment,
+        "tone": tone,
+        "engine": "+".join(engines) or None,
+        "confidence": round(min(sentiment_share, tone_share), 4),
+    }
+
+
+async def analyze_long(
+    analyzer: Analyzer,
+    text: str,
+    token_budget: int = LONG_INPUT_TOKEN_BUDGET,
+    chunk_tokens: int = LONG_INPUT_CHUNK_TOKENS,
+    concurrency: int = LONG_INPUT_CONCURRENCY
+) -> dict:
+    """Map-reduce analysis of one long email: clean, chunk, analyze chunks concurrently, merge."""
+    cleaned = strip_quoted(text)
+    chunks = split_chunks(cleaned, chunk_tokens)
+    total_tokens = sum(tokens for _, tokens in chunks)
+
+    # Spend the budget from the top, where the newest message is
+    selected = []
+    spent = 0
+    for chunk, tokens in chunks:
+        if selected and spent + tokens > token_budget:
+            break
+        selected.append((chunk, tokens))
+        spent += tokens
+
+    outcomes = await analyzer.analyze_batch([chunk for chunk, _ in selected], concurrency)
+    chunk_results = []
+    errors = []
+    for index, ((_, tokens), outcome) in enumerate(zip(selected, outcomes)):
+        if isinstance(outcome, BaseException):
+            errors.append(outcome)
+            chunk_results.append({"index": index, "tokens": tokens, "error": str(outcome)})
+            continue
+        chunk_results.append({
+            "index": index,
+            "tokens": tokens,
+            "sentiment": outcome["sentiment"],
+            "tone": outcome["tone"],
+            "engine": outcome.get("engine"),
+        })
+    succeeded = [chunk for chunk in chunk_results if "error" not in chunk]
+    if not succeeded:
+        raise errors[0]
+
+    result = merge_chunk_results(succeeded)
+    result.update({
+        "tokens": total_tokens,
+        "analyzed_tokens": spent,
+        "truncated": len(selected) < len(chunks),
+        "chunks": chunk_results,
+    })
+    return result
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import os
+import smtplib
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+SMTP_SERVER = os.getenv("SMTP_SERVER")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+SMTP_USER = os.getenv("SMTP_USER")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+# Disable for a local stand-in such as `python -m aiosmtpd -n -l localhost:8025`
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() in ("1", "true", "yes")
+SMTP_TIMEOUT_SECONDS = float(os.getenv("SMTP_TIMEOUT_SECONDS", "30"))
+MAIL_FROM = os.getenv("MAIL_FROM") or SMTP_USER
+
+# Number of authenticated SMTP sessions kept open, one per sender task
+MAIL_POOL_SIZE = int(os.getenv("MAIL_POOL_SIZE", "2"))
+MAIL_BATCH_SIZE = int(os.getenv("MAIL_BATCH_SIZE", "20"))
+MAIL_QUEUE_MAX = int(os.getenv("MAIL_QUEUE_MAX", "10000"))
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "4"))
+MAIL_RETRY_BASE_SECONDS = float(os.getenv("MAIL_RETRY_BASE_SECONDS", "2"))
+# Sessions idle longer than this are checked with NOOP before reuse
+MAIL_SESSION_IDLE_SECONDS = float(os.getenv("MAIL_SESSION_IDLE_SECONDS", "30"))
+MAIL_SHUTDOWN_TIMEOUT_SECONDS = float(os.getenv("MAIL_SHUTDOWN_TIMEOUT_SECONDS", "10"))
+
+
+class OutboundMessage:
+    def __init__(self, to_email: str, subject: str, body: str):
+        self.to_email = to_email
+        self.subject = subject
+        self.body = body
+        self.attempts = 0
+
+    def as_string(self, from_email: str) -> str:
+        msg = MIMEMultipart()
+        msg["From"] = from_email
+        msg["To"] = self.to_email
+        msg["Subject"] = self.subject
+        msg.attach(MIMEText(self.body, "plain"))
+        return msg.as_string()
+
+
+class _SMTPSession:
+    """One authenticated SMTP connection, only ever used from one sender task at a time."""
+
+    def __init__(self):
+        self._smtp = None
+        self._last_used = 0.0
+        self.opened = 0
+
+    def _connect(self):
+        smtp = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT_SECONDS)
+        if SMTP_STARTTLS:
+            smtp.starttls()
+        if SMTP_USER:
+            smtp.login(SMTP_USER, SMTP_PASSWORD)
+        self._smtp = smtp
+        self.opened += 1
+
+    def _ensure(self):
+        if self._smtp is not None and time.monotonic() - self._last_used > MAIL_SESSION_IDLE_SECONDS:
+            try:
+                if self._smtp.noop()[0] != 250:
+                    self.close()
+            except smtplib.SMTPException:
+                self.close()
+            except OSError:
+                self.close()
+        if self._smtp is None:
+            self._connect()
+
+    def send_batch(self, messages):
+        """Sends messages over this session. Returns the (message, error) pairs that failed."""
+        failures = []
+        for message in messages:
+            started = time.perf_counter()
+            try:
+                self._ensure()
+                self._smtp.sendmail(MAIL_FROM, message.to_email, message.as_string(MAIL_FROM))
+            except (smtplib.SMTPException, OSError) as e:
+                failures.append((message, e))
+                # The connection may be unusable, start a fresh one for the next message
+                self.close()
+            # Per message, including the (re)connect when the session had to open one
+            metrics.smtp_send_seconds.observe(time.perf_counter() - started)
+            self._last_used = time.monotonic()
+        return failures
+
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
+
+
+class Mailer:
+    """Queue of outbound mail drained in batches over a small pool of SMTP sessions."""
+
+    def __init__(self, pool_size: int, batch_size: int, queue_max: int):
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.queue_max = queue_max
+        self._queue = None
+        self._loop = None
+        self._tasks = []
+        self._sessions = []
+        self._started_at = None
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.batches = 0
+        self.send_seconds = 0.0
+
+    def start(self):
+        if self._tasks:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.queue_max)
+        self._started_at = time.monotonic()
+        for _ in range(self.pool_size):
+            session = _SMTPSession()
+            self._sessions.append(session)
+            self._tasks.append(asyncio.create_task(self._run_sender(session)))
+
+    async def stop(self):
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=MAIL_SHUTDOWN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning("Mailer stopped with messages still queued", extra={"queued": self._queue.qsize()})
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for session in self._sessions:
+            await asyncio.to_thread(session.close)
+        self._tasks = []
+        self._sessions = []
+
+    def enqueue(self, message: OutboundMessage) -> bool:
+        """Queues a message for delivery. Safe to call from sync routes running in the threadpool."""
+        if self._loop is None:
+            logger.warning("Mailer is not running, dropping message", extra={"to": message.to_email})
+            self.dropped += 1
+            return False
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self._loop:
+            self._put(message)
+        else:
+            self._loop.call_soon_threadsafe(self._put, message)
+        return True
+
+    def stats(self) -> dict:
+        uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "queue_max": self.queue_max,
+            "pool_size": self.pool_size,
+            "sessions_opened": sum(session.opened for session in self._sessions),
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "avg_batch_size": self.sent / self.batches if self.batches else 0.0,
+            "avg_send_seconds": self.send_seconds / self.sent if self.sent else 0.0,
+            "sent_per_second": self.sent / uptime if uptime else 0.0,
+        }
+
+    def _put(self, message: OutboundMessage):
+        try:
+            self._queue.put_nowait(message)
+            self.enqueued += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.error("Mail queue full, dropping message", extra={"to": message.to_email})
+
+    def _retry_later(self, message: OutboundMessage, error: Exception):
+        message.attempts += 1
+        if message.attempts >= MAIL_MAX_ATTEMPTS:
+            self.failed += 1
+            logger.error("Failed to send email", extra={"to": message.to_email, "attempts": message.attempts, "error": str(error)})
+            return
+        self.retried += 1
+        delay = MAIL_RETRY_BASE_SECONDS * 2 ** (message.attempts - 1)
+        self._loop.call_later(delay, self._put, message)
+
+    async def _run_sender(self, session: _SMTPSession):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            started = time.perf_counter()
+            try:
+                failures = await asyncio.to_thread(session.send_batch, batch)
+            except Exception as e:
+                failures = [(message, e) for message in batch]
+            self.send_seconds += time.perf_counter() - started
+            self.batches += 1
+            self.sent += len(batch) - len(failures)
+            for message, error in failures:
+                self._retry_later(message, error)
+            for _ in batch:
+                self._queue.task_done()
+
+
+mailer = Mailer(
+    pool_size=MAIL_POOL_SIZE,
+    batch_size=MAIL_BATCH_SIZE,
+    queue_max=MAIL_QUEUE_MAX
+)
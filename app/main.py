@@ -1,20 +1,81 @@
 from fastapi import FastAPI, Request, HTTPException, Depends
-from app import models, database
+from app import database, llm, logs, long_input, metrics, paddle, passwords, webhooks
+from app.analyzers import analyzer
+from app.cache import analysis_cache
+from app.instrumentation import MetricsMiddleware
+from app.mailer import mailer
+from app.analysis_writer import analysis_writer
+from app.usage import usage_meter
 from app.users import router as users_router
 from app.sentiment import router as sentiment_router
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
+import json
+import logging
 import os
-from datetime import datetime
-from app.database import engine
-
-# Create all tables
-models.Base.metadata.create_all(bind=engine)
+import secrets
+from contextlib import asynccontextmanager
+from app.database import get_db
+
+logger = logging.getLogger("app.main")
+
+# Optional bearer token for /metrics, leave unset when the endpoint is only reachable internally
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+logs.configure()
+
+# Existing stats() counters, exposed as gauges on /metrics
+metrics.registry.register_stats("analysis_cache", analysis_cache.stats)
+metrics.registry.register_stats("analyzer", analyzer.stats)
+metrics.registry.register_stats("mailer", mailer.stats)
+metrics.registry.register_stats("analysis_writer", analysis_writer.stats)
+metrics.registry.register_stats("usage", usage_meter.stats)
+metrics.registry.register_stats("paddle_checkout", paddle.checkout_cache.stats)
+
+def start_warm_up(coroutine) -> asyncio.Task:
+    # Never awaited, so failures are logged here instead of surfacing as "exception was never retrieved"
+    task = asyncio.create_task(coroutine)
+
+    def log_failure(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Warm-up failed", exc_info=task.exception())
+
+    task.add_done_callback(log_failure)
+    return task
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logs.start()
+    # Nothing here waits on the database or OpenAI: the schema is created by `python -m app.bootstrap`,
+    # the engine connects on first use and the OpenAI SDK is imported on first use (or preloaded, see llm.py)
+    warm_ups = [start_warm_up(llm.warm_up()), start_warm_up(long_input.warm_up())]
+    await paddle.startup()
+    passwords.startup()
+    webhooks.start_worker()
+    mailer.start()
+    analysis_writer.start()
+    usage_meter.start()
+    yield
+    for warm_up in warm_ups:
+        warm_up.cancel()
+    # Flush buffered analyses and usage counters before the engine goes away
+    await analysis_writer.stop()
+    await usage_meter.stop()
+    await mailer.stop()
+    await webhooks.stop_worker()
+    passwords.shutdown()
+    await paddle.shutdown()
+    await llm.shutdown()
+    await database.dispose()
+    logs.stop()
 
 app = FastAPI(
     title="Email Sentiment & Tone Analyzer API",
     description="Analyze email sentiment and tone with authentication.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 @app.get("/")
@@ -42,65 +103,40 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Outermost, so the latency covers everything including CORS
+app.add_middleware(MetricsMiddleware)
 
-# Dependency to get DB session
-def get_db():
-    db = database.SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+@app.get("/metrics", include_in_schema=False)
+def get_metrics(request: Request):
+    if METRICS_TOKEN and not secrets.compare_digest(request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
 
 # Paddle Webhook Endpoint (Classic and V2 support)
+# Events are appended to a durable inbox and applied by the background worker in app/webhooks.py
 @app.post("/users/paddle/webhook")
-async def paddle_webhook(request: Request, db: Session = Depends(get_db)):
+async def paddle_webhook(request: Request, db: AsyncSession = Depends(get_db)):
+    raw_body = await request.body()
     try:
-        data = await request.json()
-        print(f"Received Paddle webhook: {data}")
-
-        # Classic Paddle webhooks use 'alert_name'
-        alert_name = data.get("alert_name")
-        # Paddle V2 webhooks use 'event_type'
-        event_type = data.get("event_type")
-
-        # Use whichever is present
-        event = alert_name or event_type
-
-        if event == "subscription_created":
-            user_email = data.get("email")
-            subscription_id = data.get("subscription_id")
-            plan_id = data.get("plan_id")
-            user = db.query(models.User).filter(models.User.email == user_email).first()
-            if user:
-                user.is_subscribed = True
-                user.subscription_id = subscription_id
-                user.subscription_plan_id = plan_id
-                user.subscription_status = "active"
-                user.subscription_start_date = datetime.now()
-                db.commit()
-                print(f"User {user.username} subscription activated")
-
-        elif event == "subscription_cancelled":
-            subscription_id = data.get("subscription_id")
-            user = db.query(models.User).filter(models.User.subscription_id == subscription_id).first()
-            if user:
-                user.subscription_status = "cancelled"
-                user.subscription_end_date = datetime.now()
-                db.commit()
-                print(f"User {user.username} subscription cancelled")
-
-        elif event == "subscription_payment_succeeded":
-            subscription_id = data.get("subscription_id")
-            user = db.query(models.User).filter(models.User.subscription_id == subscription_id).first()
-            if user:
-                print(f"Payment succeeded for user {user.username}")
-
-        # Add more event handling as needed
-
-        return {"status": "success"}
+        data = json.loads(raw_body)
+        if not isinstance(data, dict):
+            raise ValueError("Webhook payload must be a JSON object")
+    except ValueError as e:
+        logger.warning("Unparseable webhook payload", extra={"error": str(e)})
+        # Still return 200 to prevent Paddle from retrying a payload we can never parse
+        return {"status": "error", "message": str(e)}
+    logger.info(
+        "Received Paddle webhook",
+        extra={"event_type": webhooks.event_name(data), "subscription_key": webhooks.subscription_key(data)}
+    )
 
+    try:
+        inserted = await webhooks.enqueue_event(db, data, raw_body)
     except Exception as e:
-        print(f"Error processing webhook: {str(e)}")
-        # Still return 200 to prevent Paddle from retrying
-        return {"status": "error", "message": str(e)}
+        logger.error("Error storing webhook", extra={"error": str(e)})
+        # Not stored, so let Paddle redeliver it
+        raise HTTPException(status_code=503, detail="Could not store webhook event")
 
+    if inserted:
+        webhooks.notify_worker()
+    return {"status": "success", "duplicate": not inserted}
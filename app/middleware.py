@@ -1,14 +1,31 @@
 from fastapi import Depends, HTTPException, status
-from app import models, auth
-from sqlalchemy.orm import Session
-from app.database import get_db
+from app import auth, metrics
+from app.usage import UsageLimitExceeded, usage_meter
 
 # Dependency to verify subscription
-def verify_subscription(db: Session = Depends(get_db), current_user = Depends(auth.get_current_user)):
-    user = db.query(models.User).filter(models.User.username == current_user.username).first()
-    if not user.is_subscribed or user.subscription_status != "active":
+# The entitlement comes from the cached principal, webhook handlers invalidate it on change
+async def verify_subscription(current_user = Depends(auth.get_current_user)):
+    with metrics.stage("subscription"):
+        entitled = current_user.is_subscribed and current_user.subscription_status == "active"
+    if not entitled:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Active subscription required to access this feature"
         )
+    return current_user
+
+def charge_usage(current_user, units: int = 1):
+    try:
+        usage_meter.acquire(current_user, units)
+    except UsageLimitExceeded as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=e.detail,
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+# Dependency for metered endpoints: per-user rate limit and monthly quota, checked in memory
+async def enforce_usage(current_user = Depends(verify_subscription)):
+    with metrics.stage("usage"):
+        charge_usage(current_user)
     return current_user
\ No newline at end of file
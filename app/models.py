@@ -1,9 +1,10 @@
-from sqlalchemy import Column, Integer, String,Boolean, DateTime, Text, ForeignKey
+from sqlalchemy import Column, Integer, String,Boolean, Date, DateTime, Text, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from app.database import Base
+from app.labels import LabelCode, SENTIMENT_CODES, TONE_CODES
 from datetime import datetime
 from pydantic import BaseModel, EmailStr
-from typing import Optional
+from typing import List, Optional
 import uuid
 
 # SQLAlchemy User model
@@ -22,7 +23,7 @@ class User(Base):
 
 	# Add these fields for Paddle integration
 	is_subscribed = Column(Boolean, default=False)
-	subscription_id = Column(String, nullable=True)
+	subscription_id = Column(String, nullable=True, index=True)
 	subscription_plan_id = Column(String, nullable=True)
 	subscription_status = Column(String, nullable=True)  # active, cancelled, paused
 	subscription_start_date = Column(DateTime, nullable=True)
@@ -34,10 +35,58 @@ class EmailAnalysis(Base):
 	id = Column(Integer, primary_key=True, index=True)
 	user_id = Column(Integer, ForeignKey("users.id"))
 	email_text = Column(Text, nullable=False)
-	sentiment = Column(String(50))
-	tone = Column(String(50))
+	sentiment = Column(LabelCode(SENTIMENT_CODES))  # SMALLINT codes, see app/labels.py
+	tone = Column(LabelCode(TONE_CODES))
+	engine = Column(String(20), nullable=True)  # local, openai; NULL for rows written before the local analyzer
 	analyzed_at = Column(DateTime, default=datetime.utcnow)
 	user = relationship("User", back_populates="analyses")
+	__table_args__ = (
+		# Backs keyset pagination of a user's history, newest first
+		Index("ix_email_analyses_user_analyzed", "user_id", "analyzed_at", "id"),
+	)
+
+# SQLAlchemy AnalysisRollup model (per user/day/label counts, maintained by app/rollups.py)
+class AnalysisRollup(Base):
+	__tablename__ = "analysis_rollups"
+	user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+	day = Column(Date, primary_key=True)
+	sentiment = Column(LabelCode(SENTIMENT_CODES), primary_key=True)  # "" (code 0) when the label is missing
+	tone = Column(LabelCode(TONE_CODES), primary_key=True)
+	count = Column(Integer, nullable=False, default=0)
+
+# SQLAlchemy AnalysisCacheEntry model (persistent tier of the analysis result cache)
+class AnalysisCacheEntry(Base):
+	__tablename__ = "analysis_cache"
+	key = Column(String(64), primary_key=True)
+	sentiment = Column(LabelCode(SENTIMENT_CODES))
+	tone = Column(LabelCode(TONE_CODES))
+	engine = Column(String(20), nullable=True)
+	details = Column(Text, nullable=True)  # JSON, the rest of the result (long-input metadata)
+	created_at = Column(DateTime, default=datetime.utcnow)
+
+# SQLAlchemy UsageCounter model (monthly analysis usage, synced from memory by app/usage.py)
+class UsageCounter(Base):
+	__tablename__ = "usage_counters"
+	user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+	period = Column(String(7), primary_key=True)  # YYYY-MM
+	plan_id = Column(String, nullable=True)
+	used = Column(Integer, nullable=False, default=0)
+	updated_at = Column(DateTime, default=datetime.utcnow)
+
+# SQLAlchemy PaddleWebhookEvent model (durable inbox drained by app/webhooks.py)
+class PaddleWebhookEvent(Base):
+	__tablename__ = "paddle_webhook_events"
+	id = Column(Integer, primary_key=True, index=True)
+	event_id = Column(String(100), unique=True, nullable=False)
+	event_type = Column(String(100), nullable=True)
+	subscription_key = Column(String(255), nullable=True, index=True)
+	payload = Column(Text, nullable=False)
+	status = Column(String(20), default="pending", index=True)  # pending, processed, failed
+	attempts = Column(Integer, default=0)
+	next_attempt_at = Column(DateTime, default=datetime.utcnow)
+	last_error = Column(Text, nullable=True)
+	received_at = Column(DateTime, default=datetime.utcnow)
+	processed_at = Column(DateTime, nullable=True)
 
 # Pydantic schemas
 class UserCreate(BaseModel):
@@ -58,9 +107,10 @@ class EmailAnalysisCreate(BaseModel):
 
 class EmailAnalysisRead(BaseModel):
 	id: int
-	email_text: str
+	email_text: Optional[str] = None  # Only loaded when explicitly requested
 	sentiment: Optional[str]
 	tone: Optional[str]
+	engine: Optional[str] = None
 	analyzed_at: datetime
 	class Config:
 		from_attributes = True
@@ -68,3 +118,10 @@ class EmailAnalysisRead(BaseModel):
 # Add this class for email text analysis
 class EmailText(BaseModel):
     email_text: str
+
+class EmailBatch(BaseModel):
+    emails: List[EmailText]
+
+class EmailAnalysisPage(BaseModel):
+    items: List[EmailAnalysisRead]
+    next_cursor: Optional[str] = None
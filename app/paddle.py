@@ -0,0 +1,248 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import httpx
+
+from app import metrics
+
+try:
+    import h2  # noqa: F401  (installed by httpx[http2])
+except ImportError:  # optional, the client falls back to HTTP/1.1
+    h2 = None
+
+logger = logging.getLogger(__name__)
+
+# Paddle API base, the sandbox unless overridden (production, or a local stand-in for load tests)
+PADDLE_API_URL = os.getenv("PADDLE_API_URL", "https://sandbox-api.paddle.com").rstrip("/")
+# Whitespace from copy-pasted keys breaks the Authorization header
+PADDLE_API_KEY = (os.getenv("PADDLE_PUBLIC_KEY") or "").strip()
+PADDLE_PRICE_ID = (os.getenv("PADDLE_PRICE_ID") or "").strip()
+
+# Connection pool and timeout tuning for the shared Paddle client
+PADDLE_HTTP2 = os.getenv("PADDLE_HTTP2", "true").lower() in ("1", "true", "yes")
+PADDLE_MAX_CONNECTIONS = int(os.getenv("PADDLE_MAX_CONNECTIONS", "20"))
+PADDLE_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("PADDLE_MAX_KEEPALIVE_CONNECTIONS", "10"))
+PADDLE_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("PADDLE_KEEPALIVE_EXPIRY_SECONDS", "60"))
+PADDLE_TIMEOUT_SECONDS = float(os.getenv("PADDLE_TIMEOUT_SECONDS", "10"))
+PADDLE_CONNECT_TIMEOUT_SECONDS = float(os.getenv("PADDLE_CONNECT_TIMEOUT_SECONDS", "3"))
+PADDLE_MAX_RETRIES = int(os.getenv("PADDLE_MAX_RETRIES", "2"))
+PADDLE_RETRY_BASE_SECONDS = float(os.getenv("PADDLE_RETRY_BASE_SECONDS", "0.2"))
+PADDLE_RETRY_MAX_SECONDS = float(os.getenv("PADDLE_RETRY_MAX_SECONDS", "2"))
+
+# How long a user's checkout URL is handed out again instead of creating a new transaction
+CHECKOUT_CACHE_SECONDS = int(os.getenv("CHECKOUT_CACHE_SECONDS", "300"))
+CHECKOUT_CACHE_SIZE = int(os.getenv("CHECKOUT_CACHE_SIZE", "10000"))
+
+# Answers that mean Paddle did not process the request. A 502 or 504 can come back after the
+# transaction was created, and POST /transactions is not idempotent, so those are not retried.
+RETRY_STATUSES = (429, 503)
+# Failures where the request never reached Paddle, so a retry cannot create a second transaction
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class PaddleError(Exception):
+    """Paddle answered, but not with what we asked for."""
+
+    def __init__(self, detail: str, status_code=None):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+
+
+_client = None
+
+
+def _build_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=PADDLE_API_URL,
+        http2=PADDLE_HTTP2 and h2 is not None,
+        timeout=httpx.Timeout(PADDLE_TIMEOUT_SECONDS, connect=PADDLE_CONNECT_TIMEOUT_SECONDS),
+        limits=httpx.Limits(
+            max_connections=PADDLE_MAX_CONNECTIONS,
+            max_keepalive_connections=PADDLE_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=PADDLE_KEEPALIVE_EXPIRY_SECONDS
+        ),
+        headers={"Authorization": f"Bearer {PADDLE_API_KEY}"}
+    )
+
+
+async def startup():
+    global _client
+    if _client is None:
+        _client = _build_client()
+
+
+async def shutdown():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    # Normally created by the app lifespan; built lazily for scripts and tests
+    global _client
+    if _client is None:
+        _client = _build_client()
+    return _client
+
+
+def _retry_delay(attempt: int, retry_after=None):
+    """Full jitter backoff. None when Paddle asks us to wait longer than PADDLE_RETRY_MAX_SECONDS."""
+    delay = random.uniform(0, min(PADDLE_RETRY_MAX_SECONDS, PADDLE_RETRY_BASE_SECONDS * 2 ** attempt))
+    if retry_after:
+        try:
+            retry_after = float(retry_after)
+        except ValueError:
+            return delay
+        if retry_after > PADDLE_RETRY_MAX_SECONDS:
+            return None
+        delay = max(delay, retry_after)
+    return delay
+
+
+async def _post(path: str, payload: dict) -> httpx.Response:
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        try:
+            response = await get_client().post(path, json=payload)
+        except RETRY_ERRORS as e:
+            metrics.upstream_seconds.observe(time.perf_counter() - started, service="paddle")
+            metrics.upstream_requests.inc(service="paddle", status="error")
+            if attempt >= PADDLE_MAX_RETRIES:
+                raise
+            delay = _retry_delay(attempt)
+            logger.warning("Paddle unreachable, retrying", extra={"attempt": attempt + 1, "error": str(e)})
+        except httpx.RequestError:
+            metrics.upstream_seconds.observe(time.perf_counter() - started, service="paddle")
+            metrics.upstream_requests.inc(service="paddle", status="error")
+            raise
+        else:
+            metrics.upstream_seconds.observe(time.perf_counter() - started, service="paddle")
+            metrics.upstream_requests.inc(service="paddle", status=response.status_code)
+            if response.status_code not in RETRY_STATUSES or attempt >= PADDLE_MAX_RETRIES:
+                return response
+            delay = _retry_delay(attempt, response.headers.get("retry-after"))
+            if delay is None:
+                return response
+            logger.warning("Paddle busy, retrying", extra={"attempt": attempt + 1, "status": response.status_code})
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def create_transaction(payload: dict) -> dict:
+    """POST /transactions, returns the transaction ("data") or raises PaddleError."""
+    response = await _post("/transactions", payload)
+    if response.status_code == 201:
+        return response.json().get("data", {})
+    try:
+        error_details = response.json()
+    except ValueError:
+        error_details = {"error": {"detail": response.text[:200]}}
+    logger.error("Paddle API failed", extra={"status": response.status_code, "details": error_details})
+    raise PaddleError(error_details.get("error", {}).get("detail", "Unknown Paddle error"), response.status_code)
+
+
+class CheckoutCache:
+    """(user id, price id) -> checkout URL, so reloading the checkout page reuses the open transaction."""
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Checkouts being created, so a double click waits for the first request instead of opening a second transaction
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+
+    def get(self, key: tuple):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: tuple, url: str):
+        if self.max_size <= 0 or self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, url)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        # Called once the subscription changes, the open transaction is then paid or no longer wanted
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    async def get_or_create(self, key: tuple, create):
+        url = self.get(key)
+        if url is not None:
+            return url
+        task = self._pending.get(key)
+        if task is None:
+            task = self._pending[key] = asyncio.ensure_future(self._create(key, create))
+        else:
+            self.joined += 1
+        # Shielded, one client disconnecting must not cancel the checkout others are waiting on
+        return await asyncio.shield(task)
+
+    async def _create(self, key: tuple, create):
+        try:
+            url = await create()
+            self.set(key, url)
+            return url
+        finally:
+            self._pending.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "joined": self.joined,
+            }
+
+
+checkout_cache = CheckoutCache(max_size=CHECKOUT_CACHE_SIZE, ttl_seconds=CHECKOUT_CACHE_SECONDS)
+
+
+async def checkout_url(user) -> str:
+    """Checkout URL for the configured price, reused for CHECKOUT_CACHE_SECONDS per user."""
+
+    async def create():
+        transaction = await create_transaction({
+            "items": [{"price_id": PADDLE_PRICE_ID, "quantity": 1}],
+            "customer": {"email": user.email},
+            "custom_data": {
+                "user_id": str(user.id),
+                "username": user.username
+            }
+        })
+        url = transaction.get("checkout", {}).get("url")
+        if not url:
+            raise PaddleError("Could not retrieve checkout URL from payment provider.")
+        return url
+
+    return await checkout_cache.get_or_create((user.id, PADDLE_PRICE_ID), create)
@@ -0,0 +1,104 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.context import CryptContext
+
+# Kept free of app imports: pool workers import this module on spawn
+
+# bcrypt work factor, hashes below it are flagged as deprecated and rehashed on login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_POOL_WORKERS = int(os.getenv("PASSWORD_POOL_WORKERS", "2"))
+# Jobs allowed to wait or run at once before new ones are rejected
+PASSWORD_POOL_MAX_PENDING = int(os.getenv("PASSWORD_POOL_MAX_PENDING", "32"))
+PASSWORD_TIMEOUT_SECONDS = float(os.getenv("PASSWORD_TIMEOUT_SECONDS", "5"))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS
+)
+
+
+class PasswordPoolBusy(Exception):
+    pass
+
+
+class PasswordTimeout(Exception):
+    pass
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed_password: str):
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+def _ping():
+    return True
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(PASSWORD_POOL_MAX_PENDING)
+
+
+def startup():
+    # Spawn the workers now rather than on the first login
+    executor = _get_executor()
+    for _ in range(PASSWORD_POOL_WORKERS):
+        executor.submit(_ping)
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn, not fork: the server process is multi-threaded
+            _executor = ProcessPoolExecutor(
+                max_workers=PASSWORD_POOL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _executor
+
+
+def submit(fn, *args):
+    if not _slots.acquire(blocking=False):
+        raise PasswordPoolBusy()
+    try:
+        future = _get_executor().submit(fn, *args)
+    except Exception:
+        _slots.release()
+        raise
+    # The slot is held until the job finishes, even if the caller gave up waiting
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+async def _wait(future):
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=PASSWORD_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise PasswordTimeout()
+
+
+async def hash_password(password: str) -> str:
+    return await _wait(submit(_hash, password))
+
+
+async def verify_and_update(password: str, hashed_password: str):
+    """Returns (valid, new_hash); new_hash is set when the stored hash should be replaced."""
+    return await _wait(submit(_verify_and_update, password, hashed_password))
@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "50000"))
+# Upper bound on how stale a cached entitlement can get on other instances
+PRINCIPAL_CACHE_TTL_SECONDS = int(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "60"))
+
+
+@dataclass(frozen=True)
+class Principal:
+    """Snapshot of the authenticated user and their subscription entitlement."""
+    id: int
+    username: str
+    email: str
+    is_subscribed: bool
+    subscription_status: Optional[str]
+    subscription_plan_id: Optional[str]
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(
+            id=user.id,
+            username=user.username,
+            email=user.email,
+            is_subscribed=bool(user.is_subscribed),
+            subscription_status=user.subscription_status,
+            subscription_plan_id=user.subscription_plan_id
+        )
+
+
+class PrincipalCache:
+    """Token -> Principal cache, bounded by size, TTL and the token's own expiry."""
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._tokens_by_username = {}
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[Principal]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            expires_at, principal = entry
+            if expires_at <= now:
+                self._remove(token)
+                return None
+            self._entries.move_to_end(token)
+            return principal
+
+    def set(self, token: str, principal: Principal, token_exp=None):
+        if self.max_size <= 0:
+            return
+        expires_at = time.time() + self.ttl_seconds
+        if token_exp is not None:
+            # Never serve a token past its own "exp" claim
+            expires_at = min(expires_at, float(token_exp))
+        with self._lock:
+            self._remove(token)
+            self._entries[token] = (expires_at, principal)
+            self._tokens_by_username.setdefault(principal.username, set()).add(token)
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def invalidate(self, username: str):
+        with self._lock:
+            for token in list(self._tokens_by_username.get(username, ())):
+                self._remove(token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_username.clear()
+
+    def _remove(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        username = entry[1].username
+        tokens = self._tokens_by_username.get(username)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_username[username]
+
+
+principal_cache = PrincipalCache(
+    max_size=PRINCIPAL_CACHE_SIZE,
+    ttl_seconds=PRINCIPAL_CACHE_TTL_SECONDS
+)
@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import gzip
+import json
+import sys
+from datetime import datetime
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import database, models, webhooks
+
+# Values per IN (...) list, keeps bind parameters under driver limits
+REPLAY_LOOKUP_CHUNK = 500
+# Users updated per transaction
+REPLAY_UPDATE_CHUNK = 1000
+# Inbox rows per insert statement (8 columns each)
+REPLAY_INSERT_CHUNK = 100
+# Progress line every this many events read
+REPLAY_PROGRESS_EVERY = 50000
+
+
+class FoldedSubscription:
+    """One subscription's events folded down to the last value each user column was given.
+
+    Every value carries the sort key of its event, so the result does not depend on the order events
+    are folded in and matches applying them one by one in that order, as the inbox worker does."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.lookup = None
+        self.changes = {}
+        self.events = 0
+
+    def add(self, data: dict, occurred_at: datetime, order: tuple):
+        self.events += 1
+        column, value = webhooks.user_lookup(data)
+        if value is not None:
+            # A subscription_created event (by email) finds the user even before the id is stored
+            rank = (column.key == "email", order)
+            if self.lookup is None or rank > self.lookup[0]:
+                self.lookup = (rank, column.key, value)
+        for name, change in webhooks.subscription_changes(data, occurred_at).items():
+            current = self.changes.get(name)
+            if current is None or order > current[0]:
+                self.changes[name] = (order, change)
+
+
+class Report:
+    def __init__(self, dry_run: bool):
+        self.dry_run = dry_run
+        self.events = 0
+        self.invalid = 0
+        self.without_subscription = 0
+        self.live_events = 0
+        self.subscriptions = 0
+        self.unmatched = 0
+        self.users_updated = 0
+        self.events_recorded = 0
+
+    def progress(self, message: str):
+        print(message, file=sys.stderr, flush=True)
+
+    def summary(self) -> str:
+        prefix = "Dry run, nothing written. " if self.dry_run else ""
+        return (
+            f"{prefix}{self.events} events read ({self.invalid} invalid lines, {self.without_subscription} without a subscription), "
+            f"{self.live_events} already-applied inbox events folded in, {self.subscriptions} subscriptions, "
+            f"{self.unmatched} without a matching user, {self.users_updated} users updated, "
+            f"{self.events_recorded} events added to the inbox"
+        )
+
+
+def read_events(path: str):
+    """Yields (line number, event or None, raw line) from an NDJSON file, gzip if it ends in .gz."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError:
+                yield line_number, None, line
+                continue
+            yield line_number, data if isinstance(data, dict) else None, line
+
+
+def chunked(items: list, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def fold_file(path: str, report: Report) -> dict:
+    folded = {}
+    started_at = datetime.utcnow()
+    for line_number, data, _ in read_events(path):
+        if data is None:
+            report.invalid += 1
+            continue
+        report.events += 1
+        key = webhooks.subscription_key(data)
+        if key is None:
+            report.without_subscription += 1
+            continue
+        subscription = folded.get(key)
+        if subscription is None:
+            subscription = folded[key] = FoldedSubscription(key)
+        # Events without a timestamp sort first, in file order (arrival order for the live endpoint),
+        # and are dated now, as if they were being received
+        occurred_at = webhooks.event_time(data, None)
+        subscription.add(data, occurred_at or started_at, (occurred_at or datetime.min, 1, line_number))
+        if report.events % REPLAY_PROGRESS_EVERY == 0:
+            report.progress(f"Read {report.events} events, {len(folded)} subscriptions")
+    report.subscriptions = len(folded)
+    return folded
+
+
+async def fold_applied_events(db: AsyncSession, folded: dict, report: Report):
+    """Folds in what the inbox worker already applied for the same subscriptions, so an export never rolls back newer state."""
+    for keys in chunked(list(folded), REPLAY_LOOKUP_CHUNK):
+        result = await db.execute(
+            select(
+                models.PaddleWebhookEvent.id,
+                models.PaddleWebhookEvent.subscription_key,
+                models.PaddleWebhookEvent.payload,
+                models.PaddleWebhookEvent.received_at
+            )
+            .where(models.PaddleWebhookEvent.subscription_key.in_(keys))
+            .where(models.PaddleWebhookEvent.status == "processed")
+        )
+        for row_id, key, payload, received_at in result.all():
+            data = json.loads(payload)
+            # Inbox rows sort before file lines at the same time, the same event in both folds to the same value
+            occurred_at = webhooks.event_time(data, received_at)
+            folded[key].add(data, occurred_at, (occurred_at, 0, row_id))
+            report.live_events += 1
+
+
+async def resolve_users(db: AsyncSession, folded: dict, report: Report) -> dict:
+    """user id -> final column values, merged across every subscription that resolves to the user."""
+    wanted = {"email": {}, "subscription_id": {}}
+    for subscription in folded.values():
+        if subscription.lookup is None:
+            report.unmatched += 1
+            continue
+        _, column, value = subscription.lookup
+        wanted[column].setdefault(value, []).append(subscription)
+
+    merged = {}
+    for column, by_value in wanted.items():
+        user_column = getattr(models.User, column)
+        found = set()
+        for values in chunked(list(by_value), REPLAY_LOOKUP_CHUNK):
+            result = await db.execute(select(models.User.id, user_column).where(user_column.in_(values)))
+            for user_id, value in result.all():
+                found.add(value)
+                changes = merged.setdefault(user_id, {})
+                for subscription in by_value[value]:
+                    for name, (order, change) in subscription.changes.items():
+                        if name not in changes or order > changes[name][0]:
+                            changes[name] = (order, change)
+        report.unmatched += sum(len(subscriptions) for value, subscriptions in by_value.items() if value not in found)
+    return {
+        user_id: {name: change for name, (_, change) in changes.items()}
+        for user_id, changes in merged.items() if changes
+    }
+
+
+async def apply_changes(changes: dict, report: Report):
+    user_ids = sorted(changes)
+    for user_ids_chunk in chunked(user_ids, REPLAY_UPDATE_CHUNK):
+        async with database.session() as db:
+            # ORM bulk UPDATE by primary key: one executemany per set of changed columns
+            await db.execute(update(models.User), [{"id": user_id, **changes[user_id]} for user_id in user_ids_chunk])
+            await db.commit()
+        report.users_updated += len(user_ids_chunk)
+        report.progress(f"Updated {report.users_updated}/{len(user_ids)} users")
+
+
+async def record_events(path: str, report: Report):
+    """Adds the replayed events to the inbox as processed, so a late redelivery by Paddle is ignored as a duplicate."""
+    async with database.session() as db:
+        insert = database.upsert(db.get_bind().dialect.name)
+        rows = []
+
+        async def flush():
+            statement = insert(models.PaddleWebhookEvent).values(rows).on_conflict_do_nothing(index_elements=["event_id"])
+            result = await db.execute(statement)
+            report.events_recorded += max(result.rowcount, 0)
+            rows.clear()
+
+        now = datetime.utcnow()
+        for _, data, raw in read_events(path):
+            if data is None:
+                continue
+            rows.append({
+                "event_id": webhooks.event_id_for(data, raw.encode("utf-8")),
+                "event_type": webhooks.event_name(data),
+                "subscription_key": webhooks.subscription_key(data),
+                "payload": raw,
+                "status": "processed",
+                "attempts": 0,
+                # The event's own time, it has been applied as of then
+                "received_at": webhooks.event_time(data, now),
+                "processed_at": now,
+            })
+            if len(rows) >= REPLAY_INSERT_CHUNK:
+                await flush()
+        if rows:
+            await flush()
+        await db.commit()
+
+
+async def replay(path: str, dry_run: bool = False) -> Report:
+    """Reconciles users with an NDJSON export of Paddle events, using the webhook handler's rules."""
+    report = Report(dry_run)
+    folded = fold_file(path, report)
+    report.progress(f"Read {report.events} events, {len(folded)} subscriptions")
+    async with database.session() as db:
+        await fold_applied_events(db, folded, report)
+        changes = await resolve_users(db, folded, report)
+    report.progress(f"{len(changes)} users to update, {report.unmatched} subscriptions without a matching user")
+    if dry_run:
+        return report
+    await apply_changes(changes, report)
+    await record_events(path, report)
+    return report
+
+
+async def _run_replay(path: str, dry_run: bool) -> Report:
+    try:
+        return await replay(path, dry_run)
+    finally:
+        await database.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay an export of Paddle webhook events (NDJSON, optionally .gz) onto users.")
+    parser.add_argument("path", help="One event payload per line, as Paddle posts them to /users/paddle/webhook")
+    parser.add_argument("--dry-run", action="store_true", help="Fold and match events without writing anything")
+    args = parser.parse_args()
+    report = asyncio.run(_run_replay(args.path, args.dry_run))
+    print(report.summary())
+    if not args.dry_run and report.users_updated:
+        print("Running instances pick up the new subscription state within PRINCIPAL_CACHE_TTL_SECONDS.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+from collections import Counter
+from datetime import date, timedelta
+
+from sqlalchemy import delete, func, insert, literal, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import database, models
+
+# Rollup keys cannot be NULL, a missing label is stored as "" (label code 0)
+MISSING_LABEL = ""
+# Rollup rows per upsert statement, keeps bind parameters under driver limits
+ROLLUP_UPSERT_CHUNK = 150
+
+
+async def add_to_rollups(db: AsyncSession, rows: list):
+    """Adds freshly inserted EmailAnalysis rows to the rollups, in the caller's transaction."""
+    counts = Counter(
+        (
+            row["user_id"],
+            row["analyzed_at"].date(),
+            row["sentiment"] or MISSING_LABEL,
+            row["tone"] or MISSING_LABEL,
+        )
+        for row in rows if row["user_id"] is not None
+    )
+    if not counts:
+        return
+    values = [
+        {"user_id": user_id, "day": day, "sentiment": sentiment, "tone": tone, "count": count}
+        # Sorted so concurrent writers take row locks in the same order
+        for (user_id, day, sentiment, tone), count in sorted(counts.items())
+    ]
+    upsert = database.upsert(db.get_bind().dialect.name)
+    for start in range(0, len(values), ROLLUP_UPSERT_CHUNK):
+        statement = upsert(models.AnalysisRollup).values(values[start:start + ROLLUP_UPSERT_CHUNK])
+        statement = statement.on_conflict_do_update(
+            index_elements=["user_id", "day", "sentiment", "tone"],
+            set_={"count": models.AnalysisRollup.count + statement.excluded.count}
+        )
+        await db.execute(statement)
+
+
+def bucket_start(day: date, granularity: str) -> date:
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())
+    if granularity == "month":
+        return day.replace(day=1)
+    return day
+
+
+async def load_stats(db: AsyncSession, user_id: int, start: date, end: date, granularity: str) -> list:
+    result = await db.execute(
+        select(
+            models.AnalysisRollup.day,
+            models.AnalysisRollup.sentiment,
+            models.AnalysisRollup.tone,
+            models.AnalysisRollup.count,
+        ).where(
+            models.AnalysisRollup.user_id == user_id,
+            models.AnalysisRollup.day >= start,
+            models.AnalysisRollup.day <= end,
+        )
+    )
+    buckets = {}
+    for day, sentiment, tone, count in result.all():
+        key = bucket_start(day, granularity)
+        bucket = buckets.setdefault(key, {"start": key, "total": 0, "sentiment": Counter(), "tone": Counter()})
+        bucket["total"] += count
+        bucket["sentiment"][sentiment or None] += count
+        bucket["tone"][tone or None] += count
+    return [
+        {
+            "start": bucket["start"],
+            "total": bucket["total"],
+            "sentiment": [{"label": label, "count": count} for label, count in bucket["sentiment"].most_common()],
+            "tone": [{"label": label, "count": count} for label, count in bucket["tone"].most_common()],
+        }
+        for _, bucket in sorted(buckets.items())
+    ]
+
+
+async def backfill(user_id: int = None) -> int:
+    """Rebuilds rollups from email_analyses. Run it while analyses are not being written."""
+    day = func.date(models.EmailAnalysis.analyzed_at)
+    # Typed literals so "" goes through the label codec like any other label
+    sentiment = func.coalesce(models.EmailAnalysis.sentiment, literal(MISSING_LABEL, models.EmailAnalysis.sentiment.type))
+    tone = func.coalesce(models.EmailAnalysis.tone, literal(MISSING_LABEL, models.EmailAnalysis.tone.type))
+    source = (
+        select(models.EmailAnalysis.user_id, day, sentiment, tone, func.count())
+        .where(models.EmailAnalysis.user_id.is_not(None))
+        .group_by(models.EmailAnalysis.user_id, day, sentiment, tone)
+    )
+    clear = delete(models.AnalysisRollup)
+    if user_id is not None:
+        source = source.where(models.EmailAnalysis.user_id == user_id)
+        clear = clear.where(models.AnalysisRollup.user_id == user_id)
+    async with database.session() as db:
+        await db.execute(clear)
+        await db.execute(
+            insert(models.AnalysisRollup).from_select(
+                ["user_id", "day", "sentiment", "tone", "count"], source
+            )
+        )
+        total = (await db.execute(select(func.count()).select_from(models.AnalysisRollup))).scalar_one()
+        await db.commit()
+    return total
+
+
+async def _run_backfill(user_id: int = None) -> int:
+    try:
+        return await backfill(user_id)
+    finally:
+        await database.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the analysis_rollups table.")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subcommands.add_parser("backfill", help="Rebuild rollups from existing analyses")
+    backfill_parser.add_argument("--user-id", type=int, default=None, help="Only rebuild this user's rollups")
+    args = parser.parse_args()
+    if args.command == "backfill":
+        total = asyncio.run(_run_backfill(args.user_id))
+        print(f"Rollups rebuilt, {total} rows in analysis_rollups")
+
+
+if __name__ == "__main__":
+    main()
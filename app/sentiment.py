@@ -1,64 +1,426 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.dependencies import get_current_user
-from app import models, database
-import openai
+from app import models, database, metrics
+from app.database import get_db
+from app.analyzers import analyzer
+from app.cache import analysis_cache, make_cache_key
+from app.long_input import LONG_INPUT_CHUNK_TOKENS, LONG_INPUT_MAX_TOKEN_BUDGET, LONG_INPUT_TOKEN_BUDGET, analyze_long, is_long
+from app.analysis_writer import analysis_row, analysis_writer, insert_analyses
+from app.rollups import load_stats
+import asyncio
+import base64
+import csv
+import io
+import json
 import os
-from app.middleware import verify_subscription
+import time
+import zlib
+from datetime import date, datetime, timedelta
+from typing import Optional
+from app.middleware import charge_usage, enforce_usage, verify_subscription
 
 router = APIRouter()
 
-# Dependency to get DB session
-def get_db():
-    db = database.SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Batch analysis limits
+ANALYZE_BATCH_MAX_ITEMS = int(os.getenv("ANALYZE_BATCH_MAX_ITEMS", "500"))
+ANALYZE_BATCH_CONCURRENCY = int(os.getenv("ANALYZE_BATCH_CONCURRENCY", "16"))
+
+# Rows fetched from the server-side cursor and written per streamed chunk
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "1000"))
+
+def analysis_version(long_input: bool, token_budget: int) -> str:
+    if not long_input:
+        return analyzer.version
+    # Chunking and budget change the result, so they are part of the cache key
+    return f"{analyzer.version}:long:{LONG_INPUT_CHUNK_TOKENS}:{token_budget}"
 
-# Load OpenAI API key from environment
-openai.api_key = os.getenv("OPENAI_API_KEY")
+async def timed_analysis(text: str, long_input: bool = False, token_budget: int = LONG_INPUT_TOKEN_BUDGET):
+    started = time.perf_counter()
+    if long_input:
+        result = await analyze_long(analyzer, text, token_budget)
+    else:
+        result = await analyzer.analyze(text)
+    return result, time.perf_counter() - started
+
+def upstream_elapsed(result: dict, elapsed: float):
+    # Only upstream latency feeds the cache's time-saved estimate
+    return elapsed if "openai" in (result.get("engine") or "") else None
+
+async def save_analyses(db: AsyncSession, rows: list, cache_entries: list):
+    # cache_entries are (cache_key, result, elapsed) for results that came from an analyzer
+    with metrics.stage("db_write"):
+        await _save_analyses(db, rows, cache_entries)
+
+async def _save_analyses(db: AsyncSession, rows: list, cache_entries: list):
+    if analysis_writer.enabled:
+        # Write-behind: buffered and flushed in bulk, the response does not wait on a commit
+        for cache_key, result, elapsed in cache_entries:
+            await analysis_cache.set(cache_key, result, elapsed=elapsed)
+        # analysis_cache is only written when the persistent tier is turned on
+        persistent = [(cache_key, result) for cache_key, result, _ in cache_entries] if analysis_cache.persist else []
+        await analysis_writer.add(rows, persistent)
+        return
+    try:
+        for cache_key, result, elapsed in cache_entries:
+            await analysis_cache.set(cache_key, result, db, elapsed=elapsed)
+        if rows:
+            await insert_analyses(db, rows)
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
 
 @router.post("/analyze")
-def analyze_email(
+async def analyze_email(
     email_text: models.EmailText, 
-    db: Session = Depends(get_db), 
-    current_user = Depends(verify_subscription)  # Changed from auth.get_current_user
+    detail: bool = False,
+    token_budget: int = Query(LONG_INPUT_TOKEN_BUDGET, ge=1, le=LONG_INPUT_MAX_TOKEN_BUDGET),
+    db: AsyncSession = Depends(get_db), 
+    current_user = Depends(enforce_usage)  # Subscription check plus rate limit and quota
 ):
-    # Call OpenAI API for sentiment and tone analysis
+    # Local model first, OpenAI only for the emails it is unsure about
     try:
-        # FIX 1: Use the string content from the Pydantic model for the prompt
-        prompt = f"Analyze the following email for sentiment and tone. Return both as short labels.\n\nEmail:\n{email_text.email_text}"
-        client = openai.OpenAI()
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=50
-        )
-        result = response.choices[0].message.content.strip()
-        # Example: "Sentiment: Positive\nTone: Friendly"
-        sentiment = None
-        tone = None
-        for line in result.splitlines():
-            if "sentiment" in line.lower():
-                sentiment = line.split(":")[-1].strip()
-            if "tone" in line.lower():
-                tone = line.split(":")[-1].strip()
-        # Store in DB
-        db_analysis = models.EmailAnalysis(
-            user_id=current_user.id if hasattr(current_user, 'id') else None,
-            # FIX 2: Use the string content from the Pydantic model for the database
-            email_text=email_text.email_text,
-            sentiment=sentiment,
-            tone=tone
+        # Long emails and threads are cleaned up, chunked and analyzed map-reduce style
+        long_input = is_long(email_text.email_text)
+        cache_key = make_cache_key(email_text.email_text, analysis_version(long_input, token_budget))
+        with metrics.stage("cache"):
+            result = await analysis_cache.get(cache_key, db)
+        cache_entries = []
+        if result is None or (detail and long_input and "chunks" not in result):
+            result, elapsed = await timed_analysis(email_text.email_text, long_input, token_budget)
+            cache_entries.append((cache_key, result, upstream_elapsed(result, elapsed)))
+        # Store in DB (cache hits still record the analysis for this user)
+        row = analysis_row(
+            current_user.id if hasattr(current_user, 'id') else None,
+            email_text.email_text,
+            result
         )
-        db.add(db_analysis)
-        db.commit()
-        db.refresh(db_analysis)
-        return {
-            "sentiment": sentiment,
-            "tone": tone,
-            "analyzed_at": db_analysis.analyzed_at
+        await save_analyses(db, [row], cache_entries)
+        response = {
+            "sentiment": result["sentiment"],
+            "tone": result["tone"],
+            "engine": result.get("engine"),
+            "analyzed_at": row["analyzed_at"]
         }
+        if long_input:
+            response["long_input"] = {
+                "tokens": result.get("tokens"),
+                "analyzed_tokens": result.get("analyzed_tokens"),
+                "truncated": result.get("truncated"),
+            }
+            if detail:
+                response["chunks"] = result.get("chunks")
+        return response
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def sse_event(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n".encode("utf-8")
+
+async def stream_analysis(user_id: Optional[int], text: str):
+    sent = set()
+    try:
+        long_input = is_long(text)
+        cache_key = make_cache_key(text, analysis_version(long_input, LONG_INPUT_TOKEN_BUDGET))
+        # Short-lived sessions: the request's session is closed before a streamed body is sent,
+        # and no connection is held while the model answers
+        async with database.session() as db:
+            with metrics.stage("cache"):
+                result = await analysis_cache.get(cache_key, db)
+        cache_entries = []
+        if result is None:
+            started = time.perf_counter()
+            if long_input:
+                # Chunks are analyzed concurrently and merged, there are no partial labels to send
+                result = await analyze_long(analyzer, text)
+            else:
+                async for field, value in analyzer.analyze_stream(text):
+                    if field == "result":
+                        result = value
+                    elif field not in sent:
+                        sent.add(field)
+                        yield sse_event(field, {field: value})
+            cache_entries.append((cache_key, result, upstream_elapsed(result, time.perf_counter() - started)))
+        for field in ("sentiment", "tone"):
+            if field not in sent:
+                yield sse_event(field, {field: result[field]})
+        row = analysis_row(user_id, text, result)
+        async with database.session() as db:
+            await save_analyses(db, [row], cache_entries)
+        yield sse_event("done", {
+            "sentiment": result["sentiment"],
+            "tone": result["tone"],
+            "engine": result.get("engine"),
+            "analyzed_at": row["analyzed_at"]
+        })
+    except Exception as e:
+        # The status line has already gone out, errors are reported in-stream
+        yield sse_event("error", {"detail": str(e)})
+
+@router.post("/analyze/stream")
+async def analyze_email_stream(
+    email_text: models.EmailText,
+    current_user = Depends(enforce_usage)
+):
+    """Server-sent events: `sentiment` and `tone` as soon as each is known, then `done` once the analysis is stored."""
+    return StreamingResponse(
+        stream_analysis(current_user.id if hasattr(current_user, 'id') else None, email_text.email_text),
+        media_type="text/event-stream",
+        # Proxies must pass events through as they come
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post("/analyze/batch")
+async def analyze_email_batch(
+    batch: models.EmailBatch,
+    db: AsyncSession = Depends(get_db),
+    current_user = Depends(verify_subscription)
+):
+    if len(batch.emails) > ANALYZE_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"A batch may contain at most {ANALYZE_BATCH_MAX_ITEMS} emails"
+        )
+    # One request against the rate limit, every email against the monthly quota
+    charge_usage(current_user, len(batch.emails))
+    texts = [item.email_text for item in batch.emails]
+    results = [None] * len(texts)
+    errors = {}
+
+    # Serve what we can from the cache, and only analyze each distinct email once
+    keys = []
+    long_keys = set()
+    for text in texts:
+        long_input = is_long(text)
+        cache_key = make_cache_key(text, analysis_version(long_input, LONG_INPUT_TOKEN_BUDGET))
+        if long_input:
+            long_keys.add(cache_key)
+        keys.append(cache_key)
+    # In-memory hits first, then a single lookup in the persistent tier for the rest
+    cached = await analysis_cache.get_many(list(dict.fromkeys(keys)), db)
+    pending = {}
+    for index, cache_key in enumerate(keys):
+        if cache_key in cached:
+            results[index] = cached[cache_key]
+        else:
+            pending.setdefault(cache_key, []).append(index)
+
+    # Scored locally as one batch, only low-confidence emails go upstream (ANALYZE_BATCH_CONCURRENCY at a time)
+    cache_keys = [cache_key for cache_key in pending if cache_key not in long_keys]
+    long_cache_keys = [cache_key for cache_key in pending if cache_key in long_keys]
+    outcomes, long_outcomes = await asyncio.gather(
+        analyzer.analyze_batch([texts[pending[cache_key][0]] for cache_key in cache_keys], ANALYZE_BATCH_CONCURRENCY),
+        asyncio.gather(
+            *(analyze_long(analyzer, texts[pending[cache_key][0]]) for cache_key in long_cache_keys),
+            return_exceptions=True
+        )
+    )
+    cache_entries = []
+    for cache_key, outcome in zip(cache_keys + long_cache_keys, list(outcomes) + list(long_outcomes)):
+        if isinstance(outcome, BaseException):
+            for index in pending[cache_key]:
+                errors[index] = str(outcome)
+            continue
+        cache_entries.append((cache_key, outcome, None))
+        for index in pending[cache_key]:
+            results[index] = outcome
+
+    # Persist every successful analysis in a single multi-row insert
+    analyzed_at = datetime.utcnow()
+    user_id = current_user.id if hasattr(current_user, 'id') else None
+    rows = [
+        analysis_row(user_id, texts[index], result, analyzed_at)
+        for index, result in enumerate(results) if result is not None
+    ]
+    try:
+        await save_analyses(db, rows, cache_entries)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+    items = []
+    for index, result in enumerate(results):
+        if result is None:
+            items.append({"index": index, "error": errors.get(index, "Analysis failed")})
+        else:
+            items.append({
+                "index": index,
+                "sentiment": result["sentiment"],
+                "tone": result["tone"],
+                "engine": result.get("engine"),
+                "analyzed_at": analyzed_at
+            })
+    return {
+        "results": items,
+        "succeeded": len(rows),
+        "failed": len(items) - len(rows)
+    }
+
+def encode_cursor(analyzed_at: datetime, analysis_id: int) -> str:
+    raw = f"{analyzed_at.isoformat()}|{analysis_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        analyzed_at, analysis_id = raw.split("|")
+        return datetime.fromisoformat(analyzed_at), int(analysis_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def history_query(user_id: int, columns: list, sentiment: Optional[str], tone: Optional[str], cursor: Optional[str], ascending: bool = False):
+    # Keyset over (analyzed_at, id), served by ix_email_analyses_user_analyzed in either direction
+    query = select(*columns).where(models.EmailAnalysis.user_id == user_id)
+    if sentiment is not None:
+        query = query.where(models.EmailAnalysis.sentiment == sentiment)
+    if tone is not None:
+        query = query.where(models.EmailAnalysis.tone == tone)
+    key = tuple_(models.EmailAnalysis.analyzed_at, models.EmailAnalysis.id)
+    if cursor is not None:
+        position = tuple_(*decode_cursor(cursor))
+        query = query.where(key > position if ascending else key < position)
+    if ascending:
+        return query.order_by(models.EmailAnalysis.analyzed_at.asc(), models.EmailAnalysis.id.asc())
+    return query.order_by(models.EmailAnalysis.analyzed_at.desc(), models.EmailAnalysis.id.desc())
+
+@router.get("/history", response_model=models.EmailAnalysisPage)
+async def get_history(
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    sentiment: Optional[str] = None,
+    tone: Optional[str] = None,
+    include_text: bool = False,
+    db: AsyncSession = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    columns = [
+        models.EmailAnalysis.id,
+        models.EmailAnalysis.sentiment,
+        models.EmailAnalysis.tone,
+        models.EmailAnalysis.engine,
+        models.EmailAnalysis.analyzed_at,
+    ]
+    if include_text:
+        columns.append(models.EmailAnalysis.email_text)
+    # One extra row tells us whether there is another page
+    query = history_query(current_user.id, columns, sentiment, tone, cursor).limit(limit + 1)
+    rows = (await db.execute(query)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].analyzed_at, rows[-1].id)
+    return {
+        "items": [models.EmailAnalysisRead(**row._mapping) for row in rows],
+        "next_cursor": next_cursor
+    }
+
+EXPORT_FIELDS = ["id", "analyzed_at", "sentiment", "tone", "engine", "email_text", "cursor"]
+
+def export_records(rows):
+    for row in rows:
+        yield {
+            "id": row.id,
+            "analyzed_at": row.analyzed_at.isoformat(),
+            "sentiment": row.sentiment,
+            "tone": row.tone,
+            "engine": row.engine,
+            "email_text": row.email_text,
+            # Pass the last received cursor back to resume an interrupted export
+            "cursor": encode_cursor(row.analyzed_at, row.id),
+        }
+
+def format_ndjson(rows) -> bytes:
+    return "".join(json.dumps(record) + "\n" for record in export_records(rows)).encode("utf-8")
+
+def format_csv(rows, header: bool) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    if header:
+        writer.writeheader()
+    writer.writerows(export_records(rows))
+    return buffer.getvalue().encode("utf-8")
+
+async def stream_export(user_id: int, format: str, cursor: Optional[str], compress: bool):
+    query = history_query(
+        user_id,
+        [
+            models.EmailAnalysis.id,
+            models.EmailAnalysis.analyzed_at,
+            models.EmailAnalysis.sentiment,
+            models.EmailAnalysis.tone,
+            models.EmailAnalysis.engine,
+            models.EmailAnalysis.email_text,
+        ],
+        None,
+        None,
+        cursor,
+        ascending=True
+    ).execution_options(yield_per=EXPORT_CHUNK_ROWS)
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    header = format == "csv" and cursor is None
+    # Own session: the request's session is closed before a streamed body is sent
+    async with database.session() as db:
+        result = await db.stream(query)
+        async for rows in result.partitions(EXPORT_CHUNK_ROWS):
+            chunk = format_ndjson(rows) if format == "ndjson" else format_csv(rows, header)
+            header = False
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+    if header:
+        # Empty export still gets its CSV header
+        chunk = format_csv([], True)
+        yield compressor.compress(chunk) if compressor is not None else chunk
+    if compressor is not None:
+        yield compressor.flush()
+
+@router.get("/export")
+async def export_analyses(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    cursor: Optional[str] = None,
+    gzip: bool = False,
+    current_user = Depends(get_current_user)
+):
+    if cursor is not None:
+        decode_cursor(cursor)
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv"
+    headers = {"Content-Disposition": f'attachment; filename="analyses.{format}"'}
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(
+        stream_export(current_user.id, format, cursor, gzip),
+        media_type=media_type,
+        headers=headers
+    )
+
+@router.get("/stats")
+async def get_stats(
+    from_: Optional[date] = Query(None, alias="from"),
+    to: Optional[date] = None,
+    granularity: str = Query("day", pattern="^(day|week|month)$"),
+    db: AsyncSession = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    # Answered from analysis_rollups, never from email_analyses
+    to = to or datetime.utcnow().date()
+    from_ = from_ or to - timedelta(days=30)
+    if from_ > to:
+        raise HTTPException(status_code=400, detail="'from' must not be after 'to'")
+    return {
+        "from": from_,
+        "to": to,
+        "granularity": granularity,
+        "buckets": await load_stats(db, current_user.id, from_, to, granularity)
+    }
+
+@router.get("/cache/stats")
+def get_cache_stats(current_user = Depends(get_current_user)):
+    return analysis_cache.stats()
+
+@router.get("/analyzer/stats")
+def get_analyzer_stats(current_user = Depends(get_current_user)):
+    return {"analyzer": analyzer.name, "version": analyzer.version, **analyzer.stats()}
@@ -0,0 +1,33 @@
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+# Module-specific tuning (pool sizes, timeouts, cache sizes) stays next to the code that uses it;
+# these are the settings several modules share.
+
+
+@dataclass(frozen=True)
+class Settings:
+    database_url: Optional[str]
+    secret_key: Optional[str]
+    algorithm: str
+    access_token_expire_minutes: int
+    # Public base URL used in links sent by email
+    api_domain: str
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        return cls(
+            database_url=os.getenv("DATABASE_URL"),
+            secret_key=os.getenv("SECRET_KEY"),
+            algorithm=os.getenv("ALGORITHM", "HS256"),
+            access_token_expire_minutes=int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30")),
+            api_domain=os.getenv("API_DOMAIN", "https://yourdomain.com").rstrip("/"),
+        )
+
+
+@lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    """Read once per process, on first use."""
+    return Settings.from_env()
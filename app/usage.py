@@ -0,0 +1,244 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy import select
+
+from app import database, models
+
+logger = logging.getLogger(__name__)
+
+# Limits for plans not listed in RATE_LIMIT_PLANS
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "2"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "20"))
+# Emails analyzed per calendar month (UTC), 0 for unlimited
+MONTHLY_QUOTA = int(os.getenv("MONTHLY_QUOTA", "10000"))
+# Per-plan overrides keyed by subscription_plan_id, e.g. {"pro": {"rate_per_second": 10, "burst": 50, "monthly_quota": 100000}}
+RATE_LIMIT_PLANS = json.loads(os.getenv("RATE_LIMIT_PLANS", "{}"))
+# How often usage is written to usage_counters and other instances' usage is read back
+USAGE_SYNC_SECONDS = float(os.getenv("USAGE_SYNC_SECONDS", "15"))
+# Counter rows per upsert statement, keeps bind parameters under driver limits
+USAGE_UPSERT_CHUNK = 150
+
+
+@dataclass(frozen=True)
+class PlanLimits:
+    rate_per_second: float
+    burst: int
+    monthly_quota: int
+
+
+DEFAULT_LIMITS = PlanLimits(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST, MONTHLY_QUOTA)
+PLAN_LIMITS = {
+    plan_id: PlanLimits(
+        float(limits.get("rate_per_second", RATE_LIMIT_PER_SECOND)),
+        int(limits.get("burst", RATE_LIMIT_BURST)),
+        int(limits.get("monthly_quota", MONTHLY_QUOTA)),
+    )
+    for plan_id, limits in RATE_LIMIT_PLANS.items()
+}
+
+
+# Longest any bucket takes to refill completely, idle buckets older than this are forgotten
+FULL_REFILL_SECONDS = max(
+    [limits.burst / limits.rate_per_second for limits in (DEFAULT_LIMITS, *PLAN_LIMITS.values()) if limits.rate_per_second > 0],
+    default=0.0
+)
+
+
+def limits_for(plan_id) -> PlanLimits:
+    return PLAN_LIMITS.get(plan_id, DEFAULT_LIMITS)
+
+
+def current_period(now: datetime) -> str:
+    return now.strftime("%Y-%m")
+
+
+def next_period_start(now: datetime) -> datetime:
+    if now.month == 12:
+        return datetime(now.year + 1, 1, 1)
+    return datetime(now.year, now.month + 1, 1)
+
+
+class UsageLimitExceeded(Exception):
+    def __init__(self, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class UsageMeter:
+    """Per-user token buckets and monthly quotas, checked in memory and synced to usage_counters in the background."""
+
+    def __init__(self, sync_seconds: float):
+        self.sync_seconds = sync_seconds
+        self._lock = threading.Lock()
+        # user_id -> (tokens, monotonic time of the last refill)
+        self._buckets = {}
+        # (user_id, period) -> used, as last read from the database (all instances)
+        self._synced = {}
+        # (user_id, period) -> [plan_id, units], written by the sync in progress / not yet written
+        self._flushing = {}
+        self._pending = {}
+        self._task = None
+        self.rate_limited = 0
+        self.quota_exceeded = 0
+        self.sync_errors = 0
+
+    def start(self):
+        if self._task is not None:
+            return
+        # The first sync runs in the background; until it lands, quotas count this instance's usage only
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        try:
+            await self.sync()
+        except Exception as e:
+            logger.error("Usage counters not saved on shutdown", extra={"error": str(e)})
+
+    def _used(self, key) -> int:
+        return (
+            self._synced.get(key, 0)
+            + self._flushing.get(key, (None, 0))[1]
+            + self._pending.get(key, (None, 0))[1]
+        )
+
+    def acquire(self, principal, units: int = 1):
+        """Takes one request from the rate bucket and `units` from the monthly quota, or raises UsageLimitExceeded."""
+        limits = limits_for(principal.subscription_plan_id)
+        now = datetime.utcnow()
+        key = (principal.id, current_period(now))
+        with self._lock:
+            if limits.rate_per_second > 0:
+                tokens, refilled_at = self._buckets.get(principal.id, (limits.burst, None))
+                clock = time.monotonic()
+                if refilled_at is not None:
+                    tokens = min(limits.burst, tokens + (clock - refilled_at) * limits.rate_per_second)
+                if tokens < 1:
+                    self.rate_limited += 1
+                    raise UsageLimitExceeded(
+                        "Rate limit exceeded",
+                        math.ceil((1 - tokens) / limits.rate_per_second)
+                    )
+            if limits.monthly_quota > 0 and self._used(key) + units > limits.monthly_quota:
+                self.quota_exceeded += 1
+                raise UsageLimitExceeded(
+                    "Monthly quota exceeded",
+                    math.ceil((next_period_start(now) - now).total_seconds())
+                )
+            # Both checks passed, only now is anything consumed
+            if limits.rate_per_second > 0:
+                self._buckets[principal.id] = (tokens - 1, clock)
+            pending = self._pending.setdefault(key, [principal.subscription_plan_id, 0])
+            pending[0] = principal.subscription_plan_id
+            pending[1] += units
+
+    def snapshot(self, principal) -> dict:
+        limits = limits_for(principal.subscription_plan_id)
+        now = datetime.utcnow()
+        period = current_period(now)
+        with self._lock:
+            used = self._used((principal.id, period))
+            tokens, refilled_at = self._buckets.get(principal.id, (limits.burst, None))
+            if refilled_at is not None:
+                tokens = min(limits.burst, tokens + (time.monotonic() - refilled_at) * limits.rate_per_second)
+        return {
+            "plan_id": principal.subscription_plan_id,
+            "period": period,
+            "used": used,
+            "monthly_quota": limits.monthly_quota or None,
+            "remaining": max(0, limits.monthly_quota - used) if limits.monthly_quota else None,
+            "resets_at": next_period_start(now),
+            "rate_per_second": limits.rate_per_second,
+            "burst": limits.burst,
+            "available_requests": int(tokens),
+        }
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "tracked_users": len(self._buckets),
+                "unsynced_counters": len(self._pending),
+                "rate_limited": self.rate_limited,
+                "quota_exceeded": self.quota_exceeded,
+                "sync_errors": self.sync_errors,
+            }
+
+    async def sync(self):
+        """Adds local usage to usage_counters, then reads back the current month for all users."""
+        with self._lock:
+            self._flushing, self._pending = self._pending, {}
+            flushing = dict(self._flushing)
+        now = datetime.utcnow()
+        period = current_period(now)
+        try:
+            async with database.session() as db:
+                values = [
+                    {"user_id": user_id, "period": key_period, "plan_id": plan_id, "used": units, "updated_at": now}
+                    # Sorted so concurrent instances take row locks in the same order
+                    for (user_id, key_period), (plan_id, units) in sorted(flushing.items())
+                ]
+                upsert = database.upsert(db.get_bind().dialect.name)
+                for start in range(0, len(values), USAGE_UPSERT_CHUNK):
+                    statement = upsert(models.UsageCounter).values(values[start:start + USAGE_UPSERT_CHUNK])
+                    statement = statement.on_conflict_do_update(
+                        index_elements=["user_id", "period"],
+                        set_={
+                            "used": models.UsageCounter.used + statement.excluded.used,
+                            "plan_id": statement.excluded.plan_id,
+                            "updated_at": statement.excluded.updated_at,
+                        }
+                    )
+                    await db.execute(statement)
+                result = await db.execute(
+                    select(models.UsageCounter.user_id, models.UsageCounter.used)
+                    .where(models.UsageCounter.period == period)
+                )
+                synced = {(user_id, period): used for user_id, used in result.all()}
+                await db.commit()
+        except Exception:
+            with self._lock:
+                self.sync_errors += 1
+                # Keep the counts, they go out with the next sync
+                for key, (plan_id, units) in self._flushing.items():
+                    pending = self._pending.setdefault(key, [plan_id, 0])
+                    pending[1] += units
+                self._flushing = {}
+            raise
+        with self._lock:
+            self._synced = synced
+            self._flushing = {}
+            self._drop_idle_buckets()
+
+    def _drop_idle_buckets(self):
+        clock = time.monotonic()
+        for user_id, (_, refilled_at) in list(self._buckets.items()):
+            # A bucket idle this long is full again, same as having no entry
+            if clock - refilled_at > FULL_REFILL_SECONDS:
+                del self._buckets[user_id]
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.warning("Usage sync failed, will retry", extra={"error": str(e)})
+            await asyncio.sleep(self.sync_seconds)
+
+
+usage_meter = UsageMeter(sync_seconds=USAGE_SYNC_SECONDS)
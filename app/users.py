@@ -1,65 +1,43 @@
-from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
-from sqlalchemy.orm import Session
-from app import models, auth, database
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import models, auth
+from app.database import get_db
 from app.models import UserCreate, UserRead
+from app.principals import principal_cache
 from fastapi.security import OAuth2PasswordRequestForm
+from app.mailer import OutboundMessage, mailer
+from app.usage import usage_meter
+from app import paddle
+import logging
 import secrets
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-import os
-from dotenv import load_dotenv
+from app.settings import get_settings
 import httpx
-import json
-
-# Load environment variables at the beginning
-load_dotenv()
 
 router = APIRouter()
 
-# Dependency to get DB session
-def get_db():
-    db = database.SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+logger = logging.getLogger(__name__)
+
+async def get_user_by(db: AsyncSession, column, value):
+    result = await db.execute(select(models.User).where(column == value))
+    return result.scalars().first()
 
 def send_verification_email(email: str, token: str):
-    # Load SMTP credentials from .env
-    smtp_server = os.getenv("SMTP_SERVER")
-    smtp_port = int(os.getenv("SMTP_PORT", 587))
-    smtp_user = os.getenv("SMTP_USER")
-    smtp_password = os.getenv("SMTP_PASSWORD")
-    from_email = smtp_user
-    to_email = email
+    # Queued for the pooled sender in app/mailer.py, delivery and retries happen off the request
     subject = "Verify your email"
-    # Get the API domain from environment variable
-    api_domain = os.getenv("API_DOMAIN", "https://yourdomain.com")  # Default value if not set
-    verify_link = f"{api_domain}/users/verify?token={token}"
+    verify_link = f"{get_settings().api_domain}/users/verify?token={token}"
     body = f"Please verify your email by clicking the following link: {verify_link}"
-    msg = MIMEMultipart()
-    msg["From"] = from_email
-    msg["To"] = to_email
-    msg["Subject"] = subject
-    msg.attach(MIMEText(body, "plain"))
-    try:
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.sendmail(from_email, to_email, msg.as_string())
-    except Exception as e:
-        print(f"Failed to send verification email: {e}")
+    mailer.enqueue(OutboundMessage(email, subject, body))
 
 @router.post("/register", response_model=UserRead)
-def register_user(user: UserCreate, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
-    db_user = db.query(models.User).filter(models.User.username == user.username).first()
+async def register_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
+    db_user = await get_user_by(db, models.User.username, user.username)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
-    db_email = db.query(models.User).filter(models.User.email == user.email).first()
+    db_email = await get_user_by(db, models.User.email, user.email)
     if db_email:
         raise HTTPException(status_code=400, detail="Email already registered")
-    hashed_password = auth.get_password_hash(user.password)
+    hashed_password = await auth.get_password_hash(user.password)
     verification_token = secrets.token_urlsafe(32)
     new_user = models.User(
         username=user.username,
@@ -69,38 +47,48 @@ def register_user(user: UserCreate, background_tasks: BackgroundTasks, db: Sessi
         verification_token=verification_token
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     # Send verification email in background
-    background_tasks.add_task(send_verification_email, user.email, verification_token)
+    send_verification_email(user.email, verification_token)
     return new_user
 
 @router.get("/verify")
-def verify_email(token: str, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.verification_token == token).first()
+async def verify_email(token: str, db: AsyncSession = Depends(get_db)):
+    user = await get_user_by(db, models.User.verification_token, token)
     if not user:
         raise HTTPException(status_code=400, detail="Invalid or expired token")
     user.is_verified = True
     user.verification_token = None
-    db.commit()
+    await db.commit()
     return {"message": "Email verified successfully"}
 
 @router.post("/loging")
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.username == form_data.username).first()
-    if not user or not auth.verify_password(form_data.password, user.hashed_password):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    user = await get_user_by(db, models.User.username, form_data.username)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid username or password",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    valid, new_hash = await auth.verify_and_update_password(form_data.password, user.hashed_password)
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if new_hash:
+        # Transparently upgrade hashes made with an older scheme or work factor
+        user.hashed_password = new_hash
+        await db.commit()
     if not user.is_verified:
         # Resend verification email
         verification_token = secrets.token_urlsafe(32)
         user.verification_token = verification_token
-        db.commit()
-        background_tasks = BackgroundTasks()  # Create a BackgroundTasks instance
-        background_tasks.add_task(send_verification_email, user.email, verification_token)
+        await db.commit()
+        send_verification_email(user.email, verification_token)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Email not verified. A new verification email has been sent.",
@@ -111,30 +99,41 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
 
 # Password reset endpoints (outline)
 @router.post("/request-password-reset")
-def request_password_reset(email: str, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.email == email).first()
+async def request_password_reset(email: str, db: AsyncSession = Depends(get_db)):
+    user = await get_user_by(db, models.User.email, email)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     reset_token = secrets.token_urlsafe(32)
     user.verification_token = reset_token  # Reuse the field for simplicity
-    db.commit()
+    await db.commit()
     # Send reset email (reuse send_verification_email for demo)
-    background_tasks.add_task(send_verification_email, email, reset_token)
+    send_verification_email(email, reset_token)
     return {"message": "Password reset email sent"}
 
 @router.post("/reset-password")
-def reset_password(token: str, new_password: str, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.verification_token == token).first()
+async def reset_password(token: str, new_password: str, db: AsyncSession = Depends(get_db)):
+    user = await get_user_by(db, models.User.verification_token, token)
     if not user:
         raise HTTPException(status_code=400, detail="Invalid or expired token")
-    user.hashed_password = auth.get_password_hash(new_password)
+    user.hashed_password = await auth.get_password_hash(new_password)
     user.verification_token = None
-    db.commit()
+    await db.commit()
+    # Drop cached sessions so tokens issued before the reset are re-validated
+    principal_cache.invalidate(user.username)
     return {"message": "Password reset successful"}
 
+@router.get("/mail/stats")
+def get_mail_stats(current_user = Depends(auth.get_current_user)):
+    return mailer.stats()
+
+@router.get("/usage")
+def get_usage(current_user = Depends(auth.get_current_user)):
+    # Served from memory, at most USAGE_SYNC_SECONDS behind other instances
+    return usage_meter.snapshot(current_user)
+
 @router.get("/subscription")
-def get_subscription_status(db: Session = Depends(get_db), current_user = Depends(auth.get_current_user)):
-    user = db.query(models.User).filter(models.User.username == current_user.username).first()
+async def get_subscription_status(db: AsyncSession = Depends(get_db), current_user = Depends(auth.get_current_user)):
+    user = await get_user_by(db, models.User.username, current_user.username)
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -149,49 +148,18 @@ def get_subscription_status(db: Session = Depends(get_db), current_user = Depend
     }
 
 @router.get("/checkout")
-async def get_checkout_url(db: Session = Depends(get_db), current_user = Depends(auth.get_current_user)):
+async def get_checkout_url(current_user = Depends(auth.get_current_user)):
     """
     Creates a checkout session directly via the Paddle API.
-    This is the most reliable method for both sandbox and production.
+    Reloads within CHECKOUT_CACHE_SECONDS get the same transaction back without calling Paddle.
     """
-    # THE FIX IS HERE: Add .strip() to remove any accidental whitespace
-    api_key = os.getenv("PADDLE_PUBLIC_KEY").strip()
-    price_id = os.getenv("PADDLE_PRICE_ID")
-
-    if not api_key or not price_id:
+    if not paddle.PADDLE_API_KEY or not paddle.PADDLE_PRICE_ID:
         raise HTTPException(status_code=500, detail="Paddle API Key or Price ID is not configured.")
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "items": [{"price_id": price_id, "quantity": 1}],
-        "customer": {"email": current_user.email},
-        "custom_data": {
-            "user_id": str(current_user.id),
-            "username": current_user.username
-        }
-    }
-
     try:
-        async with httpx.AsyncClient() as client:
-            # This URL correctly points to the Paddle Sandbox API
-            response = await client.post("https://sandbox-api.paddle.com/transactions", headers=headers, json=payload)
-
-            if response.status_code == 201:  # Success
-                response_data = response.json()
-                checkout_url = response_data.get("data", {}).get("checkout", {}).get("url")
-                if not checkout_url:
-                     raise HTTPException(status_code=500, detail="Could not retrieve checkout URL from payment provider.")
-                return {"checkout_url": checkout_url}
-            else:
-                # This part gives us specific errors if something is wrong
-                error_details = response.json()
-                error_message = error_details.get('error', {}).get('detail', 'Unknown Paddle error')
-                print(f"PADDLE API FAILED: Status: {response.status_code}, Details: {json.dumps(error_details, indent=2)}")
-                raise HTTPException(status_code=500, detail=f"Paddle Error: {error_message}")
-
+        return {"checkout_url": await paddle.checkout_url(current_user)}
+    except paddle.PaddleError as e:
+        raise HTTPException(status_code=500, detail=f"Paddle Error: {e.detail}")
     except httpx.RequestError as e:
-        print(f"Could not connect to Paddle API. Error: {e}")
+        logger.error("Could not connect to Paddle API", extra={"error": str(e)})
         raise HTTPException(status_code=503, detail="Service Unavailable: Could not connect to payment provider.")
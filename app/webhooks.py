@@ -0,0 +1,263 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from app import database, models
+from app.paddle import checkout_cache
+from app.principals import principal_cache
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "200"))
+WEBHOOK_POLL_SECONDS = float(os.getenv("WEBHOOK_POLL_SECONDS", "5"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "8"))
+WEBHOOK_RETRY_BASE_SECONDS = float(os.getenv("WEBHOOK_RETRY_BASE_SECONDS", "5"))
+WEBHOOK_RETRY_MAX_SECONDS = float(os.getenv("WEBHOOK_RETRY_MAX_SECONDS", "900"))
+# Postgres advisory lock held by whichever worker is draining the inbox
+WEBHOOK_DRAIN_LOCK_ID = 0x7061646C
+
+
+# Event handling, shared by the inbox worker and anything replaying events
+
+def event_name(data: dict):
+    # Classic Paddle webhooks use 'alert_name', Paddle V2 webhooks use 'event_type'
+    return data.get("alert_name") or data.get("event_type")
+
+
+def event_id_for(data: dict, raw_body: bytes) -> str:
+    event_id = data.get("event_id") or data.get("alert_id")
+    if event_id:
+        return str(event_id)
+    # No id in the payload: identical redeliveries still collapse onto one row
+    return "sha256:" + hashlib.sha256(raw_body).hexdigest()
+
+
+def subscription_key(data: dict):
+    # Events for one subscription are applied in arrival order
+    return data.get("subscription_id") or data.get("email")
+
+
+def event_time(data: dict, default: datetime) -> datetime:
+    """When the event happened according to Paddle (naive UTC), `default` if the payload does not say."""
+    value = data.get("occurred_at") or data.get("event_time")
+    if not value:
+        return default
+    try:
+        # V2: "2024-04-12T10:18:49.621022Z", classic: "2024-04-12 10:18:49"
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return default
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def subscription_changes(data: dict, occurred_at: datetime) -> dict:
+    event = event_name(data)
+    if event == "subscription_created":
+        return {
+            "is_subscribed": True,
+            "subscription_id": data.get("subscription_id"),
+            "subscription_plan_id": data.get("plan_id"),
+            "subscription_status": "active",
+            "subscription_start_date": occurred_at,
+        }
+    if event == "subscription_cancelled":
+        return {
+            "subscription_status": "cancelled",
+            "subscription_end_date": occurred_at,
+        }
+    return {}
+
+
+def user_lookup(data: dict):
+    """(column, value) identifying the event's user: the email for a new subscription, then the subscription id."""
+    if event_name(data) == "subscription_created":
+        return models.User.email, data.get("email")
+    return models.User.subscription_id, data.get("subscription_id")
+
+
+async def find_user(db: AsyncSession, data: dict):
+    column, value = user_lookup(data)
+    result = await db.execute(select(models.User).where(column == value))
+    return result.scalars().first()
+
+
+async def apply_event(db: AsyncSession, data: dict, occurred_at: datetime):
+    """Applies one Paddle event to its user without committing. Returns the user it changed."""
+    event = event_name(data)
+    if event not in ("subscription_created", "subscription_cancelled", "subscription_payment_succeeded"):
+        # Add more event handling as needed
+        return None
+    user = await find_user(db, data)
+    if user is None:
+        return None
+    if event == "subscription_payment_succeeded":
+        logger.info("Payment succeeded", extra={"username": user.username})
+        return None
+    for column, value in subscription_changes(data, occurred_at).items():
+        setattr(user, column, value)
+    if event == "subscription_created":
+        logger.info("Subscription activated", extra={"username": user.username})
+    else:
+        logger.info("Subscription cancelled", extra={"username": user.username})
+    return user
+
+
+# Durable inbox
+
+async def enqueue_event(db: AsyncSession, data: dict, raw_body: bytes) -> bool:
+    """Appends an event to the inbox. Returns False if it was already received."""
+    db.add(models.PaddleWebhookEvent(
+        event_id=event_id_for(data, raw_body),
+        event_type=event_name(data),
+        subscription_key=subscription_key(data),
+        payload=raw_body.decode("utf-8"),
+        status="pending",
+        attempts=0
+    ))
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        return False
+    return True
+
+
+def _retry_delay(attempts: int) -> timedelta:
+    return timedelta(seconds=min(WEBHOOK_RETRY_BASE_SECONDS * 2 ** (attempts - 1), WEBHOOK_RETRY_MAX_SECONDS))
+
+
+async def _acquire_drain_lock(db: AsyncSession) -> bool:
+    """One drainer at a time across workers and instances, held until the batch commits.
+
+    Rows skipped because another worker holds them would otherwise let later events for the same
+    subscription be applied first."""
+    if db.get_bind().dialect.name != "postgresql":
+        # SQLite is for local runs and load tests with a single writer at a time
+        return True
+    result = await db.execute(select(func.pg_try_advisory_xact_lock(WEBHOOK_DRAIN_LOCK_ID)))
+    return bool(result.scalar())
+
+
+def due_events_query(now: datetime, limit: int):
+    """Pending events whose retry is due and whose subscription has no earlier event still backing off."""
+    event = models.PaddleWebhookEvent
+    earlier = aliased(models.PaddleWebhookEvent)
+    backing_off = (
+        select(earlier.id)
+        .where(earlier.subscription_key == event.subscription_key)
+        .where(earlier.status == "pending")
+        .where(earlier.id < event.id)
+        .where(earlier.next_attempt_at > now)
+    )
+    # Filtered in SQL, so a window full of retrying events cannot starve newer ones
+    return (
+        select(event)
+        .where(event.status == "pending")
+        .where(or_(event.next_attempt_at.is_(None), event.next_attempt_at <= now))
+        .where(~backing_off.exists())
+        .order_by(event.id)
+        .limit(limit)
+    )
+
+
+async def process_pending_events(db: AsyncSession, limit: int = WEBHOOK_BATCH_SIZE) -> int:
+    """Drains one batch of the inbox in a single transaction. Returns the number of events settled."""
+    if not await _acquire_drain_lock(db):
+        await db.rollback()
+        return 0
+    now = datetime.utcnow()
+    events = (await db.execute(due_events_query(now, limit))).scalars().all()
+    settled = 0
+    # Subscriptions with an earlier event that failed in this batch
+    blocked = set()
+    touched = set()
+    for event in events:
+        key = event.subscription_key
+        if key is not None and key in blocked:
+            continue
+        try:
+            async with db.begin_nested():
+                data = json.loads(event.payload)
+                user = await apply_event(db, data, event_time(data, event.received_at or now))
+            if user is not None:
+                touched.add((user.id, user.username))
+            event.status = "processed"
+            event.processed_at = now
+            event.last_error = None
+        except Exception as e:
+            event.attempts = (event.attempts or 0) + 1
+            event.last_error = str(e)
+            if event.attempts >= WEBHOOK_MAX_ATTEMPTS:
+                event.status = "failed"
+            else:
+                event.next_attempt_at = now + _retry_delay(event.attempts)
+                if key is not None:
+                    blocked.add(key)
+            logger.warning(
+                "Error processing webhook",
+                extra={"event_id": event.event_id, "attempts": event.attempts, "error": str(e)}
+            )
+        settled += 1
+    await db.commit()
+    for user_id, username in touched:
+        principal_cache.invalidate(username)
+        checkout_cache.invalidate(user_id)
+    return settled
+
+
+async def _drain_once() -> int:
+    async with database.session() as db:
+        return await process_pending_events(db)
+
+
+_task = None
+_wakeup = None
+
+
+async def _run_worker():
+    while True:
+        _wakeup.clear()
+        try:
+            settled = await _drain_once()
+        except Exception:
+            logger.exception("Webhook worker error")
+            settled = 0
+        if settled:
+            continue
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=WEBHOOK_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_worker():
+    global _task, _wakeup
+    if _task is None:
+        _wakeup = asyncio.Event()
+        _task = asyncio.create_task(_run_worker())
+
+
+async def stop_worker():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+
+
+def notify_worker():
+    if _wakeup is not None:
+        _wakeup.set()
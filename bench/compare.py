@@ -0,0 +1,52 @@
+"""Side-by-side latency and throughput of two bench/run.py result files.
+
+    python -m bench.compare before.json after.json
+"""
+import argparse
+import json
+
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def change(before, after) -> str:
+    if not before or after is None:
+        return ""
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def rows(before: dict, after: dict):
+    levels = {level["concurrency"]: level for level in before["levels"]}
+    for level in after["levels"]:
+        old_level = levels.get(level["concurrency"])
+        if old_level is None:
+            continue
+        endpoints = dict(level["endpoints"], total=level["total"])
+        old_endpoints = dict(old_level["endpoints"], total=old_level["total"])
+        for name, stats in endpoints.items():
+            old = old_endpoints.get(name)
+            if old is None:
+                continue
+            for metric in ("p50", "p95", "p99"):
+                yield (level["concurrency"], name, metric, old["latency_ms"][metric], stats["latency_ms"][metric])
+            yield (level["concurrency"], name, "req/s", old["throughput_rps"], stats["throughput_rps"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args(argv)
+    before, after = load(args.before), load(args.after)
+    if before["config"] != after["config"]:
+        print("Warning: the runs used different settings, compare with care")
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    print(f"{'c':>4}  {'endpoint':<10} {'metric':<6} {'before':>10} {'after':>10} {'change':>8}")
+    for concurrency, name, metric, old, new in rows(before, after):
+        print(f"{concurrency:>4}  {name:<10} {metric:<6} {old:>10} {new:>10} {change(old, new):>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""Local stand-ins for OpenAI, Paddle and SMTP with injected latency, used by bench/run.py.
+
+    python -m bench.fakes --http-port 8101 --smtp-port 8125 --openai-latency-ms 400
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+from email import message_from_bytes
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from app.labels import SENTIMENT_LABELS, TONE_LABELS
+
+# Most recent message per recipient, read back by the harness to verify accounts
+inbox = {}
+
+
+class Latency:
+    """Fixed delay plus uniform jitter, in milliseconds."""
+
+    def __init__(self, ms: float, jitter_ms: float, rng: random.Random):
+        self.ms = ms
+        self.jitter_ms = jitter_ms
+        self.rng = rng
+
+    async def wait(self):
+        delay = self.ms + (self.rng.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+
+def labels_for(text: str):
+    # Same email, same answer, so repeated runs produce the same cache and rollup behaviour
+    digest = hashlib.sha256(text.encode("utf-8")).digest()
+    return SENTIMENT_LABELS[digest[0] % len(SENTIMENT_LABELS)], TONE_LABELS[digest[1] % len(TONE_LABELS)]
+
+
+def chunk(body: dict, delta: dict, finish_reason=None) -> bytes:
+    return ("data: " + json.dumps({
+        "id": "chatcmpl-bench",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": body.get("model", "bench"),
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }) + "\n\n").encode("utf-8")
+
+
+def build_http_app(openai_latency: Latency, paddle_latency: Latency, openai_first_chunk: Latency) -> Starlette:
+    async def stream_completion(body: dict, sentiment: str, tone: str):
+        # First chunk after openai_first_chunk, the rest spread over what is left of openai_latency
+        await openai_first_chunk.wait()
+        if body.get("tools"):
+            arguments = json.dumps({"sentiment": sentiment, "tone": tone})
+            pieces = [arguments[start:start + 6] for start in range(0, len(arguments), 6)]
+            yield chunk(body, {"role": "assistant", "content": None, "tool_calls": [{
+                "index": 0, "id": "call_bench", "type": "function",
+                "function": {"name": body["tools"][0]["function"]["name"], "arguments": ""},
+            }]})
+            deltas = [{"tool_calls": [{"index": 0, "function": {"arguments": piece}}]} for piece in pieces]
+        else:
+            text = f"Sentiment: {sentiment}\nTone: {tone}"
+            yield chunk(body, {"role": "assistant", "content": ""})
+            deltas = [{"content": text[start:start + 6]} for start in range(0, len(text), 6)]
+        gap = max(0.0, openai_latency.ms - openai_first_chunk.ms) / len(deltas) / 1000
+        for delta in deltas:
+            if gap:
+                await asyncio.sleep(gap)
+            yield chunk(body, delta)
+        yield chunk(body, {}, "stop")
+        yield b"data: [DONE]\n\n"
+
+    async def chat_completions(request: Request):
+        body = await request.json()
+        prompt = "\n".join(str(message.get("content") or "") for message in body.get("messages", []))
+        sentiment, tone = labels_for(prompt)
+        if body.get("stream"):
+            return StreamingResponse(stream_completion(body, sentiment, tone), media_type="text/event-stream")
+        await openai_latency.wait()
+        message = {"role": "assistant", "content": None}
+        if body.get("tools"):
+            message["tool_calls"] = [{
+                "id": "call_bench",
+                "type": "function",
+                "function": {
+                    "name": body["tools"][0]["function"]["name"],
+                    "arguments": json.dumps({"sentiment": sentiment, "tone": tone}),
+                },
+            }]
+        else:
+            message["content"] = f"Sentiment: {sentiment}\nTone: {tone}"
+        prompt_tokens = max(1, len(prompt) // 4)
+        return JSONResponse({
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "bench"),
+            "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 12, "total_tokens": prompt_tokens + 12},
+        })
+
+    async def transactions(request: Request):
+        if not request.headers.get("authorization", "").startswith("Bearer "):
+            return JSONResponse({"error": {"detail": "Missing API key"}}, status_code=403)
+        body = await request.json()
+        await paddle_latency.wait()
+        transaction_id = "txn_" + hashlib.sha1(json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest()[:20]
+        return JSONResponse(
+            {"data": {"id": transaction_id, "checkout": {"url": f"https://checkout.bench.invalid/?_ptxn={transaction_id}"}}},
+            status_code=201
+        )
+
+    async def read_mail(request: Request):
+        message = inbox.get(request.path_params["address"].lower())
+        if message is None:
+            return JSONResponse({"detail": "No mail"}, status_code=404)
+        return JSONResponse(message)
+
+    return Starlette(routes=[
+        Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+        Route("/transactions", transactions, methods=["POST"]),
+        Route("/_bench/mail/{address}", read_mail),
+    ])
+
+
+def _store(recipients: list, data: bytes):
+    message = message_from_bytes(data)
+    parts = [part for part in message.walk() if part.get_content_type() == "text/plain"]
+    body = parts[0].get_payload(decode=True).decode("utf-8", "replace") if parts else ""
+    for recipient in recipients:
+        inbox[recipient.lower()] = {"subject": message.get("Subject"), "body": body}
+
+
+def smtp_handler(latency: Latency):
+    """Just enough SMTP for smtplib without STARTTLS or AUTH."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        recipients = []
+
+        async def reply(line: str):
+            writer.write(line.encode("ascii") + b"\r\n")
+            await writer.drain()
+
+        await reply("220 bench ESMTP")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line[:4].decode("ascii", "replace").upper()
+                if command == "EHLO":
+                    await reply("250-bench")
+                    await reply("250 8BITMIME")
+                elif command in ("HELO", "MAIL", "NOOP"):
+                    await reply("250 OK")
+                elif command == "RSET":
+                    recipients = []
+                    await reply("250 OK")
+                elif command == "RCPT":
+                    match = re.search(rb"<([^>]*)>", line)
+                    if match:
+                        recipients.append(match.group(1).decode("utf-8"))
+                    await reply("250 OK")
+                elif command == "DATA":
+                    await reply("354 End data with <CR><LF>.<CR><LF>")
+                    lines = []
+                    while True:
+                        data_line = await reader.readline()
+                        if not data_line or data_line in (b".\r\n", b".\n"):
+                            break
+                        lines.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                    await latency.wait()
+                    _store(recipients, b"".join(lines))
+                    recipients = []
+                    await reply("250 OK queued")
+                elif command == "QUIT":
+                    await reply("221 Bye")
+                    break
+                else:
+                    await reply("502 Command not implemented")
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(args):
+    rng = random.Random(args.seed)
+    app = build_http_app(
+        Latency(args.openai_latency_ms, args.jitter_ms, rng),
+        Latency(args.paddle_latency_ms, args.jitter_ms, rng),
+        Latency(args.openai_first_chunk_ms, args.jitter_ms, rng)
+    )
+    smtp = await asyncio.start_server(smtp_handler(Latency(args.smtp_latency_ms, args.jitter_ms, rng)), args.host, args.smtp_port)
+    server = uvicorn.Server(uvicorn.Config(app, host=args.host, port=args.http_port, log_level="warning", access_log=False))
+    async with smtp:
+        await server.serve()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--http-port", type=int, default=8101)
+    parser.add_argument("--smtp-port", type=int, default=8125)
+    parser.add_argument("--openai-latency-ms", type=float, default=400)
+    parser.add_argument("--openai-first-chunk-ms", type=float, default=150, help="Time to the first chunk of a streamed completion")
+    parser.add_argument("--paddle-latency-ms", type=float, default=250)
+    parser.add_argument("--smtp-latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(serve(parse_args()))
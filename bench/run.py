@@ -0,0 +1,464 @@
+"""Load test of app.main:app against SQLite and the stand-ins in bench/fakes.py.
+
+    python -m bench.run --scenario mixed --concurrency 1 8 32 --requests 400 --output bench-results.json
+
+Every run starts from an empty database with the same seeded users and emails, so two result
+files from different commits can be diffed directly (or with `python -m bench.compare`).
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Relative weights of each operation
+SCENARIOS = {
+    "mixed": {"register": 1, "login": 2, "analyze": 12, "webhook": 2, "checkout": 1},
+    "analyze": {"analyze": 1},
+    "stream": {"analyze": 1, "analyze_stream": 1},
+    "auth": {"register": 1, "login": 3},
+    "billing": {"webhook": 3, "checkout": 1},
+}
+
+# Environment of the app under test; anything here can be overridden with --env
+APP_ENV = {
+    "SECRET_KEY": "bench-secret",
+    "ALGORITHM": "HS256",
+    "OPENAI_API_KEY": "bench",
+    "PADDLE_PUBLIC_KEY": "bench",
+    "PADDLE_PRICE_ID": "pri_bench",
+    "SMTP_USER": "",
+    "SMTP_PASSWORD": "",
+    "SMTP_STARTTLS": "false",
+    "MAIL_FROM": "bench@example.com",
+    # Measure the request path, not the limiter turning traffic away
+    "RATE_LIMIT_PER_SECOND": "0",
+    "MONTHLY_QUOTA": "0",
+    "WEBHOOK_POLL_SECONDS": "0.5",
+    "LOG_LEVEL": "WARNING",
+}
+
+PASSWORD = "bench-password-1"
+
+# Share of analyze requests that resend an earlier email (cache hits), and that are long threads
+REPEAT_SHARE = 0.2
+LONG_SHARE = 0.05
+
+_OPENERS = [
+    "Thanks so much for the quick turnaround on this.",
+    "I am writing about the invoice we received last week.",
+    "Following up on yesterday's call.",
+    "This is the third time I have had to ask about this.",
+    "Please find the signed contract attached.",
+    "We need this fixed before the release on Friday.",
+    "Hope you had a great weekend!",
+    "Per our agreement, the payment is now overdue.",
+]
+_BODIES = [
+    "The dashboard keeps timing out when we export reports.",
+    "Our team really appreciates how responsive support has been.",
+    "Could you confirm the new pricing applies to existing seats?",
+    "The migration went smoothly and everyone is happy with the result.",
+    "Nobody has replied to my ticket and the outage is still ongoing.",
+    "Let me know if a call on Tuesday works for you.",
+    "The numbers in the quarterly report do not match our records.",
+    "We would like to add five more users to our plan.",
+]
+_CLOSERS = ["Best regards,", "Thanks,", "Cheers,", "Regards,", "Waiting for your answer.", "Kind regards,"]
+
+
+class EmailSource:
+    """Seeded email texts: short one-offs, repeats of earlier emails and the odd long thread."""
+
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+        self.sent = []
+
+    def _short(self) -> str:
+        rng = self.rng
+        sentences = [rng.choice(_OPENERS)] + rng.sample(_BODIES, rng.randint(1, 4))
+        return " ".join(sentences) + f"\n\n{rng.choice(_CLOSERS)}\nCustomer #{rng.randint(1, 10 ** 6)}"
+
+    def _thread(self) -> str:
+        rng = self.rng
+        replies = []
+        for _ in range(rng.randint(12, 24)):
+            replies.append(f"On Mon, {rng.randint(1, 28)} Jan at 10:{rng.randint(10, 59)}, someone wrote:")
+            replies.extend("> " + line for line in self._short().splitlines())
+        return self._short() + "\n\n" + "\n".join(replies)
+
+    def next(self) -> str:
+        roll = self.rng.random()
+        if self.sent and roll < REPEAT_SHARE:
+            return self.rng.choice(self.sent)
+        text = self._thread() if roll < REPEAT_SHARE + LONG_SHARE else self._short()
+        self.sent.append(text)
+        return text
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values: list, share: float) -> float:
+    # Nearest rank
+    index = max(0, min(len(sorted_values) - 1, int(round(share * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples: list, wall_seconds: float) -> dict:
+    latencies = sorted(ms for ms, _ in samples)
+    statuses = {}
+    for _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = sum(count for status, count in statuses.items() if not status.isdigit() or int(status) >= 400)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "statuses": statuses,
+        "throughput_rps": round(len(samples) / wall_seconds, 2) if wall_seconds else None,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies), 2),
+            "p50": round(percentile(latencies, 0.50), 2),
+            "p95": round(percentile(latencies, 0.95), 2),
+            "p99": round(percentile(latencies, 0.99), 2),
+            "max": round(latencies[-1], 2),
+        },
+    }
+
+
+def bootstrap(env: dict):
+    """Creates the schema the way a deploy would, the app itself no longer does."""
+    result = subprocess.run([sys.executable, "-m", "app.bootstrap"], cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"app.bootstrap failed:\n{result.stderr}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{' '.join(process.args)} exited with {process.returncode}")
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.emails = EmailSource(random.Random(args.seed + 1))
+        self.users = []
+        self.registered = 0
+        self.events = 0
+        # (ms, status) from request start to the first server-sent event, per level
+        self.first_events = []
+        self.processes = []
+        self.client = None
+
+    # Processes
+
+    def _spawn(self, argv: list, env: dict) -> subprocess.Popen:
+        process = subprocess.Popen(argv, cwd=ROOT, env=env)
+        self.processes.append(process)
+        return process
+
+    async def start(self, workdir: str):
+        args = self.args
+        http_port, smtp_port, app_port = free_port(), free_port(), free_port()
+        self.fakes_url = f"http://127.0.0.1:{http_port}"
+        self.app_url = f"http://127.0.0.1:{app_port}"
+
+        fakes = self._spawn([
+            sys.executable, "-m", "bench.fakes",
+            "--http-port", str(http_port), "--smtp-port", str(smtp_port),
+            "--openai-latency-ms", str(args.openai_latency_ms),
+            "--openai-first-chunk-ms", str(args.openai_first_chunk_ms),
+            "--paddle-latency-ms", str(args.paddle_latency_ms),
+            "--smtp-latency-ms", str(args.smtp_latency_ms),
+            "--jitter-ms", str(args.jitter_ms),
+            "--seed", str(args.seed),
+        ], dict(os.environ))
+        await wait_until_up(self.fakes_url, fakes)
+
+        env = dict(os.environ)
+        env.update(APP_ENV)
+        env.update({
+            "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+            "OPENAI_BASE_URL": f"{self.fakes_url}/v1",
+            "PADDLE_API_URL": self.fakes_url,
+            "SMTP_SERVER": "127.0.0.1",
+            "SMTP_PORT": str(smtp_port),
+            "API_DOMAIN": self.app_url,
+        })
+        env.update(dict(item.split("=", 1) for item in args.env))
+        bootstrap(env)
+        app = self._spawn([
+            sys.executable, "-m", "uvicorn", "app.main:app",
+            "--host", "127.0.0.1", "--port", str(app_port),
+            "--workers", str(args.workers), "--log-level", "warning", "--no-access-log",
+        ], env)
+        await wait_until_up(self.app_url + "/", app)
+
+        limits = httpx.Limits(max_connections=max(args.concurrency) + 8, max_keepalive_connections=max(args.concurrency) + 8)
+        self.client = httpx.AsyncClient(base_url=self.app_url, limits=limits, timeout=args.timeout)
+
+    async def stop(self):
+        if self.client is not None:
+            await self.client.aclose()
+        for process in reversed(self.processes):
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    # Setup: verified, subscribed, logged-in users
+
+    async def _mail_token(self, email: str) -> str:
+        async with httpx.AsyncClient(base_url=self.fakes_url) as fakes:
+            for _ in range(200):
+                response = await fakes.get(f"/_bench/mail/{email}")
+                if response.status_code == 200:
+                    match = re.search(r"token=([\w\-]+)", response.json()["body"])
+                    if match:
+                        return match.group(1)
+                await asyncio.sleep(0.05)
+        raise RuntimeError(f"No verification email for {email}")
+
+    async def _check(self, response: httpx.Response):
+        if response.status_code >= 400:
+            raise RuntimeError(f"{response.request.method} {response.request.url.path} -> {response.status_code}: {response.text}")
+        return response
+
+    async def _create_user(self, index: int) -> dict:
+        username = f"bench{index}"
+        email = f"bench{index}@example.com"
+        await self._check(await self.client.post(
+            "/users/register", json={"username": username, "email": email, "password": PASSWORD}
+        ))
+        token = await self._mail_token(email)
+        await self._check(await self.client.get("/users/verify", params={"token": token}))
+        login = await self._check(await self.client.post(
+            "/users/loging", data={"username": username, "password": PASSWORD}
+        ))
+        user = {
+            "username": username,
+            "email": email,
+            "subscription_id": f"sub_bench{index}",
+            "headers": {"Authorization": f"Bearer {login.json()['access_token']}"},
+        }
+        await self._check(await self.client.post("/users/paddle/webhook", json={
+            "event_id": f"evt_setup_{index}",
+            "alert_name": "subscription_created",
+            "email": email,
+            "subscription_id": user["subscription_id"],
+            "plan_id": "bench",
+        }))
+        return user
+
+    async def setup_users(self):
+        semaphore = asyncio.Semaphore(8)
+
+        async def create(index):
+            async with semaphore:
+                return await self._create_user(index)
+
+        self.users = list(await asyncio.gather(*(create(index) for index in range(self.args.users))))
+        self.registered = len(self.users)
+        # The inbox worker applies subscription_created in the background
+        for user in self.users:
+            for _ in range(200):
+                response = await self._check(await self.client.get("/users/subscription", headers=user["headers"]))
+                if response.json()["subscription_status"] == "active":
+                    break
+                await asyncio.sleep(0.05)
+            else:
+                raise RuntimeError(f"Subscription of {user['username']} was never applied")
+
+    # Operations, each returns the response
+
+    async def op_register(self):
+        self.registered += 1
+        index = self.registered
+        return await self.client.post("/users/register", json={
+            "username": f"bench{index}", "email": f"bench{index}@example.com", "password": PASSWORD
+        })
+
+    async def op_login(self):
+        user = self.rng.choice(self.users)
+        return await self.client.post("/users/loging", data={"username": user["username"], "password": PASSWORD})
+
+    async def op_analyze(self):
+        user = self.rng.choice(self.users)
+        return await self.client.post("/sentiment/analyze", json={"email_text": self.emails.next()}, headers=user["headers"])
+
+    async def op_analyze_stream(self):
+        user = self.rng.choice(self.users)
+        started = time.perf_counter()
+        async with self.client.stream(
+            "POST", "/sentiment/analyze/stream", json={"email_text": self.emails.next()}, headers=user["headers"]
+        ) as response:
+            async for line in response.aiter_lines():
+                if started is not None and line.startswith("event: "):
+                    # What an interactive client waits for before showing anything
+                    status = "sse_error" if line == "event: error" else response.status_code
+                    self.first_events.append(((time.perf_counter() - started) * 1000, status))
+                    started = None
+        return response
+
+    async def op_webhook(self):
+        user = self.rng.choice(self.users)
+        self.events += 1
+        return await self.client.post("/users/paddle/webhook", json={
+            "event_id": f"evt_bench_{self.events}",
+            "alert_name": "subscription_payment_succeeded",
+            "email": user["email"],
+            "subscription_id": user["subscription_id"],
+        })
+
+    async def op_checkout(self):
+        user = self.rng.choice(self.users)
+        return await self.client.get("/users/checkout", headers=user["headers"])
+
+    # Load
+
+    async def run_level(self, mix: dict, concurrency: int, requests: int) -> dict:
+        names = list(mix)
+        # Drawn up front so the sequence only depends on the seed, not on scheduling
+        plan = self.rng.choices(names, weights=[mix[name] for name in names], k=requests)
+        operations = [getattr(self, f"op_{name}") for name in plan]
+        samples = {name: [] for name in names}
+        self.first_events = []
+        position = 0
+
+        async def worker():
+            nonlocal position
+            while position < len(plan):
+                index = position
+                position += 1
+                started = time.perf_counter()
+                try:
+                    response = await operations[index]()
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                samples[plan[index]].append(((time.perf_counter() - started) * 1000, status))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - started
+        everything = [sample for values in samples.values() for sample in values]
+        if self.first_events:
+            # Reported per endpoint only, these requests are already counted in total
+            samples["analyze_stream_first_event"] = self.first_events
+        return {
+            "concurrency": concurrency,
+            "requests": requests,
+            "wall_seconds": round(wall, 3),
+            "total": summarize(everything, wall),
+            "endpoints": {name: summarize(values, wall) for name, values in sorted(samples.items()) if values},
+        }
+
+
+async def main(args):
+    mix = SCENARIOS[args.scenario]
+    report = {
+        "commit": git_commit(),
+        "started_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "scenario": args.scenario,
+            "mix": mix,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "users": args.users,
+            "workers": args.workers,
+            "seed": args.seed,
+            "latency_ms": {
+                "openai": args.openai_latency_ms,
+                "openai_first_chunk": args.openai_first_chunk_ms,
+                "paddle": args.paddle_latency_ms,
+                "smtp": args.smtp_latency_ms,
+                "jitter": args.jitter_ms,
+            },
+            "env": sorted(args.env),
+        },
+        "levels": [],
+    }
+    harness = Harness(args)
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        try:
+            await harness.start(workdir)
+            await harness.setup_users()
+            for concurrency in args.concurrency:
+                if args.warmup:
+                    await harness.run_level(mix, concurrency, args.warmup)
+                level = await harness.run_level(mix, concurrency, args.requests)
+                report["levels"].append(level)
+                total = level["total"]
+                print(
+                    f"c={concurrency:<4} {total['throughput_rps']:>8} req/s  "
+                    f"p50 {total['latency_ms']['p50']}ms  p95 {total['latency_ms']['p95']}ms  "
+                    f"p99 {total['latency_ms']['p99']}ms  errors {total['errors']}",
+                    file=sys.stderr
+                )
+        finally:
+            await harness.stop()
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"Wrote {args.output}", file=sys.stderr)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="mixed")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=400, help="Measured requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=20, help="Unmeasured requests before each level")
+    parser.add_argument("--users", type=int, default=20, help="Verified, subscribed users created before the run")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--openai-latency-ms", type=float, default=400)
+    parser.add_argument("--openai-first-chunk-ms", type=float, default=150)
+    parser.add_argument("--paddle-latency-ms", type=float, default=250)
+    parser.add_argument("--smtp-latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--timeout", type=float, default=60, help="Client timeout per request, seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Extra app environment, e.g. ANALYZER=openai")
+    parser.add_argument("--output", default="bench-results.json")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,130 @@
+"""Cold start of app.main:app: import time, time until uvicorn accepts connections, and first-request latency.
+
+    python -m bench.startup --runs 5 --output startup-results.json
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import httpx
+
+from bench.run import APP_ENV, ROOT, bootstrap, free_port, git_commit
+
+IMPORT_SNIPPET = "import time; started = time.perf_counter(); import app.main; print(time.perf_counter() - started)"
+
+
+def measure_import(env: dict) -> float:
+    result = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import app.main failed:\n{result.stderr}")
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def wait_for_port(port: int, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"uvicorn exited with {process.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.005)
+    raise RuntimeError(f"Port {port} did not open within {timeout}s")
+
+
+def timed(send) -> float:
+    started = time.perf_counter()
+    send()
+    return (time.perf_counter() - started) * 1000
+
+
+def measure_boot(env: dict) -> dict:
+    port = free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "app.main:app",
+        "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning", "--no-access-log",
+    ], cwd=ROOT, env=env)
+    try:
+        # uvicorn only listens once the lifespan startup has finished
+        wait_for_port(port, process)
+        ready = time.perf_counter() - started
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}") as client:
+            first = timed(lambda: client.get("/"))
+            # Unknown user: no bcrypt work, but the first query opens the engine and a connection
+            first_db = timed(lambda: client.post("/users/loging", data={"username": "nobody", "password": "x"}))
+            warm = timed(lambda: client.get("/"))
+            warm_db = timed(lambda: client.post("/users/loging", data={"username": "nobody", "password": "x"}))
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return {
+        "ready_seconds": ready,
+        "first_request_ms": first,
+        "first_db_request_ms": first_db,
+        "warm_request_ms": warm,
+        "warm_db_request_ms": warm_db,
+    }
+
+
+def summarize(values: list) -> dict:
+    return {
+        "median": round(statistics.median(values), 4),
+        "min": round(min(values), 4),
+        "max": round(max(values), 4),
+    }
+
+
+def main(args):
+    samples = {}
+    with tempfile.TemporaryDirectory(prefix="bench-startup-") as workdir:
+        env = dict(os.environ)
+        env.update(APP_ENV)
+        env["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+        env.update(dict(item.split("=", 1) for item in args.env))
+        bootstrap(env)
+        for run in range(args.runs):
+            results = {"import_seconds": measure_import(env), **measure_boot(env)}
+            for name, value in results.items():
+                samples.setdefault(name, []).append(value)
+            print(
+                f"run {run + 1}: import {results['import_seconds']:.3f}s  ready {results['ready_seconds']:.3f}s  "
+                f"first request {results['first_request_ms']:.1f}ms  first DB request {results['first_db_request_ms']:.1f}ms",
+                file=sys.stderr
+            )
+    report = {
+        "commit": git_commit(),
+        "started_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {"runs": args.runs, "env": sorted(args.env)},
+        "results": {name: summarize(values) for name, values in sorted(samples.items())},
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"Wrote {args.output}", file=sys.stderr)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Extra app environment")
+    parser.add_argument("--output", default="startup-results.json")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    main(parse_args())
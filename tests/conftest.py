@@ -0,0 +1,27 @@
+import os
+
+import pytest
+
+# Read by app modules at import time
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("ALGORITHM", "HS256")
+
+from app import database
+from app.bootstrap import create_schema
+from app.settings import get_settings
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def db(tmp_path, monkeypatch):
+    """Fresh SQLite database with the full schema; yields nothing, use database.session()."""
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'test.db'}")
+    get_settings.cache_clear()
+    await create_schema()
+    yield
+    await database.dispose()
+    get_settings.cache_clear()
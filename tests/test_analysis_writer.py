@@ -0,0 +1,79 @@
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
+
+from app import database, models, sentiment
+from app.analysis_writer import AnalysisWriter, analysis_row
+from app.cache import AnalysisCache
+
+pytestmark = pytest.mark.anyio
+
+RESULT = {"sentiment": "Positive", "tone": "Friendly", "engine": "openai"}
+
+
+async def count(model) -> int:
+    async with database.session() as session:
+        return (await session.execute(select(func.count()).select_from(model))).scalar()
+
+
+@pytest.fixture
+async def writer():
+    writer = AnalysisWriter(enabled=True, flush_rows=100, flush_interval_ms=60000, max_rows=1000)
+    writer.start()
+    yield writer
+    await writer.stop()
+
+
+async def test_write_behind_leaves_cache_table_alone_without_persistence(db, writer, monkeypatch):
+    monkeypatch.setattr(sentiment, "analysis_writer", writer)
+    monkeypatch.setattr(sentiment, "analysis_cache", AnalysisCache(max_size=100, ttl_seconds=60, persist=False))
+    rows = [analysis_row(None, "Thanks!", RESULT)]
+    async with database.session() as session:
+        await sentiment.save_analyses(session, rows, [("thanks", RESULT, 0.4)])
+    await writer.flush()
+    assert await count(models.EmailAnalysis) == 1
+    assert await count(models.AnalysisCacheEntry) == 0
+
+
+async def test_flush_survives_a_key_stored_in_the_meantime(db, writer):
+    async with database.session() as session:
+        await AnalysisCache(max_size=100, ttl_seconds=60, persist=True).set("thanks", RESULT, session)
+        await session.commit()
+    await writer.add([analysis_row(None, "Thanks!", RESULT)], [("thanks", RESULT)])
+    await writer.flush()
+    assert writer.stats()["flush_errors"] == 0
+    assert await count(models.EmailAnalysis) == 1
+    assert await count(models.AnalysisCacheEntry) == 1
+
+
+async def test_a_rejected_row_is_dropped_and_the_rest_written(db, writer):
+    bad = {**analysis_row(None, "bad", RESULT), "email_text": None}
+    await writer.add([analysis_row(None, "first", RESULT), bad, analysis_row(None, "second", RESULT)])
+    await writer.flush()
+    assert await count(models.EmailAnalysis) == 2
+    assert writer.stats()["buffered"] == 0 and writer.stats()["rows_dropped"] == 1
+
+    # Later flushes are no longer held back
+    await writer.add([analysis_row(None, "third", RESULT)])
+    await writer.flush()
+    assert await count(models.EmailAnalysis) == 3
+
+
+async def test_rows_are_kept_but_bounded_while_the_database_is_down(db):
+    writer = AnalysisWriter(enabled=True, flush_rows=100, flush_interval_ms=60000, max_rows=3)
+    writer.start()
+
+    async def unavailable(rows, cache_entries):
+        raise OperationalError("INSERT", {}, Exception("connection refused"))
+
+    writer._write = unavailable
+    await writer.add([analysis_row(None, "first", RESULT), analysis_row(None, "second", RESULT)], [("a", RESULT), ("b", RESULT)])
+    await writer.flush()
+    assert writer.stats()["buffered"] == 2 and writer.stats()["rows_dropped"] == 0
+
+    await writer.add([analysis_row(None, f"more {index}", RESULT) for index in range(3)], [(f"c{index}", RESULT) for index in range(3)])
+    assert writer.stats()["buffered"] == 3 and len(writer._cache_entries) == 3
+    # Back up: the buffered rows go out on shutdown
+    del writer._write
+    await writer.stop()
+    assert await count(models.EmailAnalysis) == 3
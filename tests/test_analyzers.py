@@ -0,0 +1,48 @@
+import pytest
+
+from app.analyzers import LOCAL_CONFIDENCE_THRESHOLD, Analyzer, LocalAnalyzer, TieredAnalyzer
+
+pytestmark = pytest.mark.anyio
+
+
+class RecordingAnalyzer(Analyzer):
+    name = "remote"
+
+    def __init__(self):
+        self.texts = []
+
+    async def analyze(self, text: str) -> dict:
+        self.texts.append(text)
+        return {"sentiment": "Negative", "tone": "Frustrated", "engine": self.name, "confidence": None}
+
+
+@pytest.mark.parametrize("text", [
+    "Great, another outage. Thanks a lot.",
+    "Thanks for nothing, this is broken again.",
+    "Awesome, the invoice is wrong. Love it.",
+])
+async def test_praise_next_to_complaints_escalates(text):
+    remote = RecordingAnalyzer()
+    analyzer = TieredAnalyzer(LocalAnalyzer(), remote, LOCAL_CONFIDENCE_THRESHOLD)
+    result = await analyzer.analyze(text)
+    assert remote.texts == [text]
+    assert result["engine"] == "remote"
+
+
+@pytest.mark.parametrize("text, sentiment, tone", [
+    ("Thanks so much, this is great", "Positive", "Friendly"),
+    ("This is unacceptable, I am furious", "Negative", "Frustrated"),
+])
+async def test_unambiguous_mail_stays_local(text, sentiment, tone):
+    remote = RecordingAnalyzer()
+    analyzer = TieredAnalyzer(LocalAnalyzer(), remote, LOCAL_CONFIDENCE_THRESHOLD)
+    result = await analyzer.analyze(text)
+    assert remote.texts == []
+    assert (result["sentiment"], result["tone"], result["engine"]) == (sentiment, tone, "local")
+
+
+async def test_batch_escalates_only_the_sarcastic_mail():
+    remote = RecordingAnalyzer()
+    analyzer = TieredAnalyzer(LocalAnalyzer(), remote, LOCAL_CONFIDENCE_THRESHOLD)
+    results = await analyzer.analyze_batch(["Thanks so much, this is great", "Great, another outage. Thanks a lot."])
+    assert [result["engine"] for result in results] == ["local", "remote"]
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+from sqlalchemy import event, func, select
+
+from app import database, models
+from app.cache import AnalysisCache
+
+pytestmark = pytest.mark.anyio
+
+
+async def count_entries() -> int:
+    async with database.session() as session:
+        return (await session.execute(select(func.count()).select_from(models.AnalysisCacheEntry))).scalar()
+
+
+async def test_concurrent_misses_on_the_same_key_both_commit(db):
+    cache = AnalysisCache(max_size=100, ttl_seconds=60, persist=True)
+    started = asyncio.Event()
+
+    async def miss_then_store(tone: str):
+        async with database.session() as session:
+            assert await cache.get("same-email", session) is None
+            started.set()
+            await started.wait()
+            await cache.set("same-email", {"sentiment": "Positive", "tone": tone, "engine": "openai"}, session)
+            await session.commit()
+
+    await asyncio.gather(miss_then_store("Friendly"), miss_then_store("Formal"))
+    assert await count_entries() == 1
+
+
+async def test_persistent_hit_keeps_long_input_metadata(db):
+    result = {
+        "sentiment": "Negative",
+        "tone": "Urgent",
+        "engine": "openai",
+        "confidence": 0.75,
+        "tokens": 9000,
+        "analyzed_tokens": 6000,
+        "truncated": True,
+    }
+    async with database.session() as session:
+        await AnalysisCache(max_size=100, ttl_seconds=60, persist=True).set("long-email", result, session)
+        await session.commit()
+
+    # A new process: nothing in memory, answered from the table
+    cache = AnalysisCache(max_size=100, ttl_seconds=60, persist=True)
+    async with database.session() as session:
+        assert await cache.get("long-email", session) == result
+    assert cache.stats()["persistent_hits"] == 1
+
+
+async def test_get_many_looks_up_every_memory_miss_in_one_query(db):
+    stored = AnalysisCache(max_size=100, ttl_seconds=60, persist=True)
+    async with database.session() as session:
+        for index in range(3):
+            await stored.set(f"email-{index}", {"sentiment": "Neutral", "tone": "Formal", "engine": "local"}, session)
+        await session.commit()
+
+    cache = AnalysisCache(max_size=100, ttl_seconds=60, persist=True)
+    await cache.set("in-memory", {"sentiment": "Positive", "tone": "Friendly", "engine": "local"})
+    statements = []
+    listen = lambda *args: statements.append(args[2])
+    event.listen(database.get_engine().sync_engine, "before_cursor_execute", listen)
+    try:
+        async with database.session() as session:
+            found = await cache.get_many(["in-memory", "email-0", "email-1", "email-2", "unknown"], session)
+    finally:
+        event.remove(database.get_engine().sync_engine, "before_cursor_execute", listen)
+
+    assert sorted(found) == ["email-0", "email-1", "email-2", "in-memory"]
+    assert len([sql for sql in statements if sql.lstrip().upper().startswith("SELECT")]) == 1
+    stats = cache.stats()
+    assert (stats["hits"], stats["persistent_hits"], stats["misses"]) == (1, 3, 1)
@@ -0,0 +1,46 @@
+import math
+import types
+
+import pytest
+
+from app import long_input
+
+pytestmark = pytest.mark.anyio
+
+TEXT = "word " * 2000
+
+
+def stub_tiktoken(calls: list, fail: bool):
+    def load(name):
+        calls.append(name)
+        if fail:
+            raise ConnectionError("no network")
+        return types.SimpleNamespace(encode=lambda text, disallowed_special=(): text.split())
+
+    return types.SimpleNamespace(encoding_for_model=load, get_encoding=load)
+
+
+@pytest.fixture
+def encoding(monkeypatch):
+    monkeypatch.setattr(long_input, "_encoding", None)
+    monkeypatch.setattr(long_input, "_encoding_failed", False)
+
+
+async def test_failed_load_falls_back_to_the_estimate_without_retrying(encoding, monkeypatch):
+    calls = []
+    monkeypatch.setattr(long_input, "tiktoken", stub_tiktoken(calls, fail=True))
+    await long_input.warm_up()
+    await long_input.warm_up()
+    assert long_input.is_long(TEXT)
+    assert long_input.count_tokens(TEXT) == math.ceil(len(TEXT) / long_input.CHARS_PER_TOKEN)
+    assert len(calls) == 1
+
+
+async def test_requests_never_load_the_encoding(encoding, monkeypatch):
+    calls = []
+    monkeypatch.setattr(long_input, "tiktoken", stub_tiktoken(calls, fail=False))
+    assert long_input.count_tokens(TEXT) == math.ceil(len(TEXT) / long_input.CHARS_PER_TOKEN)
+    assert calls == []
+    await long_input.warm_up()
+    assert long_input.count_tokens(TEXT) == 2000
+    assert len(calls) == 1
@@ -0,0 +1,85 @@
+import gzip
+import json
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, select
+
+from app import database, models, replay
+
+pytestmark = pytest.mark.anyio
+
+
+def write_events(path, events: list):
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, "wt", encoding="utf-8") as f:
+        for event in events:
+            f.write(event if isinstance(event, str) else json.dumps(event))
+            f.write("\n")
+    return str(path)
+
+
+CREATED = {
+    "event_id": "evt_1", "alert_name": "subscription_created", "email": "a@example.com",
+    "subscription_id": "sub_a", "plan_id": "pro", "occurred_at": "2024-04-01T10:00:00Z",
+}
+CANCELLED = {
+    "event_id": "evt_2", "alert_name": "subscription_cancelled", "subscription_id": "sub_a",
+    "occurred_at": "2024-04-20T10:00:00Z",
+}
+
+
+def test_fold_does_not_depend_on_file_order(tmp_path):
+    in_order = replay.fold_file(write_events(tmp_path / "a.ndjson", [CREATED, CANCELLED]), replay.Report(True))
+    reversed_ = replay.fold_file(write_events(tmp_path / "b.ndjson.gz", [CANCELLED, CREATED, "{broken"]), replay.Report(True))
+    for folded in (in_order, reversed_):
+        changes = {name: change for name, (_, change) in folded["sub_a"].changes.items()}
+        assert changes["subscription_status"] == "cancelled"
+        assert changes["subscription_end_date"] == datetime(2024, 4, 20, 10)
+        assert changes["subscription_start_date"] == datetime(2024, 4, 1, 10)
+        # The created event finds the user by email, before the subscription id is stored
+        assert folded["sub_a"].lookup[1:] == ("email", "a@example.com")
+
+
+async def add_user():
+    async with database.session() as db:
+        db.add(models.User(username="a", email="a@example.com", hashed_password="x", is_verified=True))
+        await db.commit()
+
+
+async def load_user() -> models.User:
+    async with database.session() as db:
+        return (await db.execute(select(models.User).where(models.User.email == "a@example.com"))).scalar_one()
+
+
+async def test_replay_applies_the_folded_state_and_records_events(db, tmp_path):
+    await add_user()
+    path = write_events(tmp_path / "events.ndjson", [CANCELLED, CREATED])
+
+    report = await replay.replay(path, dry_run=True)
+    assert report.users_updated == 0 and (await load_user()).subscription_status is None
+
+    report = await replay.replay(path)
+    user = await load_user()
+    assert (user.subscription_id, user.subscription_status, user.is_subscribed) == ("sub_a", "cancelled", True)
+    assert (report.users_updated, report.events_recorded) == (1, 2)
+
+    # A second run finds both events already in the inbox
+    report = await replay.replay(path)
+    assert report.events_recorded == 0
+    async with database.session() as session:
+        assert (await session.execute(select(func.count()).select_from(models.PaddleWebhookEvent))).scalar() == 2
+
+
+async def test_replay_never_rolls_back_newer_inbox_state(db, tmp_path):
+    await add_user()
+    async with database.session() as session:
+        session.add(models.PaddleWebhookEvent(
+            event_id="evt_live", event_type="subscription_cancelled", subscription_key="sub_a",
+            payload=json.dumps({**CANCELLED, "event_id": "evt_live", "occurred_at": "2024-05-01T00:00:00Z"}),
+            status="processed", attempts=0, received_at=datetime(2024, 5, 1)
+        ))
+        await session.commit()
+    await replay.replay(write_events(tmp_path / "events.ndjson", [CREATED]))
+    user = await load_user()
+    assert (user.subscription_status, user.subscription_end_date) == ("cancelled", datetime(2024, 5, 1))
@@ -0,0 +1,101 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from app import database, models, webhooks
+
+pytestmark = pytest.mark.anyio
+
+
+def later(seconds: int = 600) -> datetime:
+    return datetime.utcnow() + timedelta(seconds=seconds)
+
+
+async def add_user(email: str, subscription_id: str = None):
+    async with database.session() as db:
+        db.add(models.User(
+            username=email.split("@")[0], email=email, hashed_password="x", is_verified=True,
+            subscription_id=subscription_id, is_subscribed=subscription_id is not None,
+            subscription_status="active" if subscription_id else None
+        ))
+        await db.commit()
+
+
+async def add_event(event_id: str, data: dict, next_attempt_at: datetime = None, attempts: int = 0, payload: str = None):
+    async with database.session() as db:
+        db.add(models.PaddleWebhookEvent(
+            event_id=event_id,
+            event_type=webhooks.event_name(data),
+            subscription_key=webhooks.subscription_key(data),
+            payload=payload if payload is not None else json.dumps(data),
+            status="pending",
+            attempts=attempts,
+            next_attempt_at=next_attempt_at or datetime.utcnow()
+        ))
+        await db.commit()
+
+
+async def drain(limit: int = webhooks.WEBHOOK_BATCH_SIZE) -> int:
+    async with database.session() as db:
+        return await webhooks.process_pending_events(db, limit)
+
+
+async def statuses() -> dict:
+    async with database.session() as db:
+        rows = (await db.execute(select(models.PaddleWebhookEvent.event_id, models.PaddleWebhookEvent.status))).all()
+    return dict(rows)
+
+
+async def user(email: str) -> models.User:
+    async with database.session() as db:
+        return (await db.execute(select(models.User).where(models.User.email == email))).scalar_one()
+
+
+async def test_retrying_events_do_not_starve_newer_ones(db):
+    await add_user("new@example.com")
+    for index in range(3):
+        await add_event(f"evt_retry_{index}", {"alert_name": "subscription_cancelled", "subscription_id": f"sub_{index}"}, later(), attempts=1)
+    await add_event("evt_new", {"alert_name": "subscription_created", "email": "new@example.com", "subscription_id": "sub_new"})
+
+    # The oldest `limit` pending rows are all backing off
+    assert await drain(limit=3) == 1
+    assert (await user("new@example.com")).subscription_status == "active"
+    assert (await statuses())["evt_retry_0"] == "pending"
+
+
+async def test_events_wait_behind_an_earlier_event_backing_off(db):
+    await add_user("a@example.com", "sub_a")
+    await add_user("b@example.com", "sub_b")
+    await add_event("evt_a1", {"alert_name": "subscription_payment_succeeded", "subscription_id": "sub_a"}, later(), attempts=1)
+    await add_event("evt_a2", {"alert_name": "subscription_cancelled", "subscription_id": "sub_a"})
+    await add_event("evt_b1", {"alert_name": "subscription_cancelled", "subscription_id": "sub_b"})
+
+    assert await drain() == 1
+    assert await statuses() == {"evt_a1": "pending", "evt_a2": "pending", "evt_b1": "processed"}
+    assert (await user("a@example.com")).subscription_status == "active"
+    assert (await user("b@example.com")).subscription_status == "cancelled"
+
+
+async def test_failure_blocks_later_events_for_the_subscription(db):
+    await add_user("a@example.com", "sub_a")
+    await add_event("evt_a1", {"alert_name": "subscription_cancelled", "subscription_id": "sub_a"}, payload="{not json")
+    await add_event("evt_a2", {"alert_name": "subscription_cancelled", "subscription_id": "sub_a"})
+
+    assert await drain() == 1
+    async with database.session() as session:
+        failed = (await session.execute(
+            select(models.PaddleWebhookEvent).where(models.PaddleWebhookEvent.event_id == "evt_a1")
+        )).scalar_one()
+    assert failed.attempts == 1 and failed.next_attempt_at > datetime.utcnow()
+    assert (await statuses())["evt_a2"] == "pending"
+    # Still held back on the next pass, until evt_a1 is retried
+    assert await drain() == 0
+    assert (await user("a@example.com")).subscription_status == "active"
+
+
+def test_due_events_query_compiles_for_postgres():
+    sql = str(webhooks.due_events_query(datetime.utcnow(), 10).compile(dialect=postgresql.dialect()))
+    assert "NOT (EXISTS" in sql and "next_attempt_at <=" in sql